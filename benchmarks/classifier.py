@@ -0,0 +1,99 @@
+""" Parity and throughput of the classifier backends, run from the repository root with
+`python benchmarks/classifier.py`, needs openpyxl (and onnxruntime for COLD-onnx).
+
+Texts are sampled from the bundled ToxicSpans and hatexplain sheets. Every backend is compared
+with the fp32 `COLD` reference, the exit code is 1 when a poison probability is further off than
+the tolerance of its backend.
+"""
+from __future__ import annotations
+
+import sys
+import json
+import time
+import random
+import argparse
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import chat
+
+# sheet file: text column
+SAMPLES = {
+    "ToxicSpans数据集.xlsx": "译文",
+    "hatexplain数据集.xlsx": "数据",
+}
+
+# largest allowed absolute difference of the poison probability to the reference
+TOLERANCES = {
+    "COLD-int8": 0.05,
+    "COLD-onnx": 1e-4,
+}
+
+
+def load_samples(count: int, seed: int) -> list[str]:
+    import openpyxl
+
+    texts = []
+    for name, column in SAMPLES.items():
+        workbook = openpyxl.load_workbook(ROOT / name, read_only=True)
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        index = next(rows).index(column)
+        sheet_texts = [row[index] for row in rows if row[index]]
+        texts += random.Random(seed).sample(sheet_texts, min(count, len(sheet_texts)))
+    return texts
+
+
+def run(name: str, texts: list[str], threads: int) -> tuple[list[list[float]], float]:
+    analyzer = chat.get_backend(chat.ANALYZERS, name)
+    if threads:
+        chat.torch.set_num_threads(threads)
+        analyzer.threads = threads
+    model = analyzer()
+    model.analyze_batch(texts[: model.batch_size])  # warm up
+
+    started = time.perf_counter()
+    metrics = model.analyze_batch(texts)
+    return metrics, len(texts) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare classifier backends with the fp32 reference.")
+    parser.add_argument("-n", "--count", help="Texts sampled from each sheet.", type=int, default=500)
+    parser.add_argument("-b", "--backends", help="Comma separated analyzers.", default="COLD-int8,COLD-onnx")
+    parser.add_argument("-t", "--threads", help="Intra-op threads of every backend.", type=int)
+    parser.add_argument("--seed", help="Seed of the sampling.", type=int, default=0)
+    parser.add_argument("-o", "--output", help="Save results as json.")
+    args = parser.parse_args()
+
+    texts = load_samples(args.count, args.seed)
+    reference, reference_speed = run("COLD", texts, args.threads)
+    print(f"COLD: {reference_speed:.1f} texts/s")
+
+    results = {"COLD": {"texts_per_second": reference_speed}}
+    for name in args.backends.split(","):
+        metrics, speed = run(name, texts, args.threads)
+        error = max(abs(metric[1] - ref[1]) for metric, ref in zip(metrics, reference))
+        agree = sum((metric[1] > 0.5) == (ref[1] > 0.5) for metric, ref in zip(metrics, reference)) / len(texts)
+        results[name] = {
+            "texts_per_second": speed,
+            "speedup": speed / reference_speed,
+            "max_abs_error": error,
+            "label_agreement": agree,
+            "tolerance": TOLERANCES.get(name),
+            "ok": error <= TOLERANCES.get(name, float("inf")),
+        }
+        print(
+            f"{name}: {speed:.1f} texts/s ({speed / reference_speed:.2f}x), "
+            f"max error {error:.2e} (tolerance {TOLERANCES.get(name)}), label agreement {agree:.2%}"
+        )
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+    sys.exit(0 if all(result.get("ok", True) for result in results.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+""" Startup time of chat.py, run from the repository root with `python benchmarks/startup.py`.
+
+Each case runs in a fresh interpreter and the best wall time of a few runs is compared with its
+target, the exit code is 1 when a target is missed.
+"""
+from __future__ import annotations
+
+import sys
+import json
+import time
+import argparse
+import subprocess
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent.parent
+
+# seconds, on a machine where `python -c pass` takes a few tens of milliseconds
+TARGETS = {
+    "help": 0.5,
+    "chatgpt": 1.5,
+}
+
+CHATGPT = f"""
+import sys
+sys.path.insert(0, {str(ROOT)!r})
+import chat
+chat.get_backend(chat.MODELS, "ChatGPT")()
+assert "torch" not in sys.modules, "ChatGPT path imported torch"
+assert "transformers" not in sys.modules, "ChatGPT path imported transformers"
+"""
+
+
+def best_time(command: list[str], repeat: int, cwd: str) -> float:
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run(command, check=True, cwd=cwd, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure startup time of chat.py.")
+    parser.add_argument("-n", "--repeat", help="Runs of each case.", type=int, default=5)
+    parser.add_argument("-o", "--output", help="Save results as json.")
+    args = parser.parse_args()
+
+    cases = {
+        "help": [sys.executable, str(ROOT / "chat.py"), "--help"],
+        "chatgpt": [sys.executable, "-c", CHATGPT],
+    }
+
+    results = {}
+    with tempfile.TemporaryDirectory() as cwd:  # the ChatGPT cache is created in the working directory
+        for name, command in cases.items():
+            seconds = best_time(command, args.repeat, cwd)
+            results[name] = {"seconds": seconds, "target": TARGETS[name], "ok": seconds <= TARGETS[name]}
+            print(f"{name}: {seconds:.3f}s (target {TARGETS[name]}s)")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+    sys.exit(0 if all(result["ok"] for result in results.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+""" Throughput of generation, scoring and output parsing, run from the repository root with
+`python benchmarks/suite.py -o results.json`.
+
+Everything runs offline on CPU: a tiny causal LM and a tiny BERT classifier are randomly
+initialized into a temporary directory, and synthetic output files are written in each of the
+three text formats `metric.get_chats` understands. Pass `--compare` an older result file to see
+the change of every number.
+"""
+from __future__ import annotations
+
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import chat
+import metric
+
+WORDS = ["hello", "world", "你好", "世界", "问", "答", "line", "at", "[brackets]", "@", "=="]
+
+# record formats of `metric.CHAT_PATTERNS`, filled with user text, system text and 4 probs
+FORMATS = {
+    "user_system_metrics": "[USER]: {}\n[SYSTEM]: {}\n[METRICS]: User: [{:.6f}, {:.6f}], System: [{:.6f}, {:.6f}]\n",
+    "input_output": "@@@@@@@@@@\nInput is: {}\nOutput is: {}\nInput Metric is: [{:.6f}, {:.6f}]\n"
+                    "Output Metric is: [{:.6f}, {:.6f}]\n@@@@@@@@@@\n",
+    "usr_sys": "Usr >>> {}\nSys >>> {}\nUsr Metric: [{:.6f}, {:.6f}], Sys Metric: [{:.6f}, {:.6f}]\n==========\n",
+}
+
+
+def build_models(path: Path) -> tuple[Path, Path]:
+    """ Random tiny BERT classifier and GPT-2 LM sharing a character vocabulary. """
+    import transformers
+
+    chars = sorted(set("abcdefghijklmnopqrstuvwxyz0123456789,.!?:[]<>/@=你好世界问答"))
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "</s>"] + chars
+    (path / "vocab.txt").write_text("\n".join(vocab))
+    tokenizer = transformers.BertTokenizerFast(str(path / "vocab.txt"), tokenize_chinese_chars=True)
+
+    bert, gpt = path / "bert", path / "gpt"
+    tokenizer.save_pretrained(bert)
+    transformers.BertForSequenceClassification(transformers.BertConfig(
+        vocab_size=len(vocab), hidden_size=64, num_hidden_layers=2, num_attention_heads=2,
+        intermediate_size=128, num_labels=2,
+    )).save_pretrained(bert)
+
+    tokenizer.eos_token = "</s>"
+    tokenizer.save_pretrained(gpt)
+    transformers.GPT2LMHeadModel(transformers.GPT2Config(
+        vocab_size=len(vocab), n_embd=64, n_layer=2, n_head=2, n_positions=1024,
+        bos_token_id=tokenizer.eos_token_id, eos_token_id=tokenizer.eos_token_id,
+    )).save_pretrained(gpt)
+
+    return bert, gpt
+
+
+def random_text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, words)))
+
+
+def bench_chat(gpt: Path, prompts: list[str], max_new_tokens: int, batch_size: int) -> dict[str, float]:
+    import transformers
+
+    class TinyModel(chat.FireflyModel):
+        url = str(gpt)
+        generate_kwargs = dict(max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, do_sample=False)
+
+        def __init__(self) -> None:
+            self.tokenizer = transformers.AutoTokenizer.from_pretrained(self.url)
+            self.model = transformers.AutoModelForCausalLM.from_pretrained(self.url).eval()
+            self.kv_cache = chat.PrefixCache()
+            self.stopper = chat.StopOnSequences(self.tokenizer, self.stop_sequences)
+
+    model = TinyModel()
+    model.chat(prompts[0])  # warm up
+
+    def count_tokens(responses: list[str]) -> int:
+        return sum(len(model.tokenizer(response, add_special_tokens=False).input_ids) for response in responses)
+
+    started = time.perf_counter()
+    responses = [model.chat(prompt)[0] for prompt in prompts]
+    seconds = time.perf_counter() - started
+    results = {
+        "chat_prompts_per_second": len(prompts) / seconds,
+        "chat_tokens_per_second": count_tokens(responses) / seconds,
+    }
+
+    started = time.perf_counter()
+    responses = [response for batch in chat.batched(prompts, batch_size) for response in model.chat_batch(batch)]
+    seconds = time.perf_counter() - started
+    results["chat_batch_prompts_per_second"] = len(prompts) / seconds
+    results["chat_batch_tokens_per_second"] = count_tokens(responses) / seconds
+    return results
+
+
+def bench_analyze(bert: Path, texts: list[str]) -> dict[str, float]:
+    class TinyAnalyzeModel(chat.AnalyzeModel):
+        url = str(bert)
+
+    model = TinyAnalyzeModel()
+    model.analyze(texts[0])  # warm up
+
+    started = time.perf_counter()
+    for text in texts:
+        model.analyze(text)
+    results = {"analyze_texts_per_second": len(texts) / (time.perf_counter() - started)}
+
+    started = time.perf_counter()
+    model.analyze_batch(texts)
+    results["analyze_batch_texts_per_second"] = len(texts) / (time.perf_counter() - started)
+
+    model.window, model.window_overlap = 64, 16
+    started = time.perf_counter()
+    model.analyze_batch(texts)
+    results["analyze_window_texts_per_second"] = len(texts) / (time.perf_counter() - started)
+    return results
+
+
+def bench_parse(path: Path, rng: random.Random, records: int) -> dict[str, float]:
+    results = {}
+    for name, template in FORMATS.items():
+        file = path / f"{name}.txt"
+        with open(file, "w") as f:
+            for _ in range(records):
+                probs = [rng.random() for _ in range(4)]
+                f.write(template.format(random_text(rng, 30), random_text(rng, 60), *probs))
+
+        megabytes = file.stat().st_size / 1e6
+        started = time.perf_counter()
+        count = sum(1 for _ in metric.load_chats(file))
+        seconds = time.perf_counter() - started
+        assert count == records, f"{name}: parsed {count} of {records} chats"
+        results[f"parse_{name}_mb_per_second"] = megabytes / seconds
+    return results
+
+
+def environment() -> dict[str, str | int]:
+    import torch
+    import transformers
+
+    commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "machine": platform.machine(),
+        "threads": torch.get_num_threads(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline throughput benchmarks on tiny random models.")
+    parser.add_argument("-p", "--prompts", help="Prompts generated for the chat benchmarks.", type=int, default=64)
+    parser.add_argument("-t", "--tokens", help="New tokens of every response.", type=int, default=32)
+    parser.add_argument("-b", "--batch-size", help="Batch size of chat_batch.", type=int, default=16)
+    parser.add_argument("-n", "--texts", help="Texts scored by the analyze benchmarks.", type=int, default=512)
+    parser.add_argument("-r", "--records", help="Chats in each synthetic output file.", type=int, default=20000)
+    parser.add_argument("--seed", help="Seed of the synthetic data.", type=int, default=0)
+    parser.add_argument("-o", "--output", help="Save results as json.")
+    parser.add_argument("--compare", help="Earlier json results to compare with.")
+    args = parser.parse_args()
+
+    import torch
+
+    torch.manual_seed(args.seed)
+    rng = random.Random(args.seed)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        bert, gpt = build_models(Path(tmp))
+        results.update(bench_chat(gpt, [random_text(rng, 20) for _ in range(args.prompts)], args.tokens, args.batch_size))
+        results.update(bench_analyze(bert, [random_text(rng, 80) for _ in range(args.texts)]))
+        results.update(bench_parse(Path(tmp), rng, args.records))
+
+    before = json.loads(Path(args.compare).read_text())["results"] if args.compare else {}
+    for name, value in results.items():
+        change = f" ({value / before[name] - 1:+.1%})" if before.get(name) else ""
+        print(f"{name}: {value:.1f}{change}")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps({"environment": environment(), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import typing as T
+from pathlib import Path
+
+
+class ChatCache:
+    """ Persistent chat responses in SQLite (WAL mode), safe for several writing processes. """
+
+    def __init__(self, path: str | Path, timeout: float = 60) -> None:
+        self.path = Path(path)
+        self.conn = sqlite3.connect(self.path, timeout=timeout, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS chats ("
+                "key TEXT PRIMARY KEY, model TEXT, messages TEXT, response TEXT)"
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS imports (file TEXT PRIMARY KEY)")
+
+    @staticmethod
+    def key(model: str, messages: list[dict], params: dict[str, T.Any]) -> str:
+        data = json.dumps([model, messages, params], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        row = self.conn.execute("SELECT response FROM chats WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, model: str, messages: list[dict], response: str):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO chats VALUES (?, ?, ?, ?)",
+                (key, model, json.dumps(messages, ensure_ascii=False), response),
+            )
+
+    def import_json(self, path: str | Path, model: str, params: dict[str, T.Any] = None) -> int:
+        """ Import an old `{text: {"history": ..., "output": [response, history]}}` json cache once.
+
+        The old cache did not record the model, so every entry is filed under `model`.
+        Returns the number of imported entries, 0 if the file was imported before, also by another
+        process importing it at the same time.
+        """
+        path = Path(path)
+        if not path.exists():
+            return 0
+
+        name = str(path.absolute())
+        if self.imported(name):
+            return 0
+
+        json_str = path.read_text()
+        entries = json.loads(json_str) if json_str else {}
+
+        rows = []
+        for text, entry in entries.items():
+            messages = entry["history"] + [{"role": "user", "content": text}]
+            response = entry["output"][0]
+            rows.append((self.key(model, messages, params or {}), model, json.dumps(messages, ensure_ascii=False), response))
+
+        # the write lock is taken before checking again, so only one process imports the file
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            if self.imported(name):
+                return 0
+            self.conn.executemany("INSERT OR IGNORE INTO chats VALUES (?, ?, ?, ?)", rows)
+            self.conn.execute("INSERT OR IGNORE INTO imports VALUES (?)", (name,))
+
+        return len(rows)
+
+    def imported(self, name: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM imports WHERE file = ?", (name,)).fetchone() is not None
+
+    def close(self):
+        self.conn.close()
+
+
+class ScoreCache:
+    """ Classifier scores in SQLite, keyed by classifier, truncation policy and text.
+
+    Shared by every run and model, so a text is only scored once. The least recently used
+    entries are evicted once the cache holds more than `max_entries`.
+    """
+
+    def __init__(self, path: str | Path, max_entries: int = 10_000_000, timeout: float = 60) -> None:
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=timeout, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, scores TEXT, used REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS scores_used ON scores (used)")
+
+        # upper bound of the entries, only counted again when it passes `max_entries`
+        self.size = self.conn.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+    @staticmethod
+    def key(classifier: str, policy: str, text: str) -> str:
+        text_hash = hashlib.sha256(text.encode()).hexdigest()
+        return hashlib.sha256(f"{classifier}\0{policy}\0{text_hash}".encode()).hexdigest()
+
+    def get_many(self, keys: list[str]) -> dict[str, T.Any]:
+        found = {}
+        with self.lock:
+            # sqlite limits the number of parameters of a statement
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, scores FROM scores WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                found.update((key, json.loads(scores)) for key, scores in rows)
+
+            if found:
+                now = time.time()
+                with self.conn:
+                    self.conn.executemany("UPDATE scores SET used = ? WHERE key = ?", [(now, key) for key in found])
+
+        return found
+
+    def put_many(self, items: dict[str, T.Any]):
+        if not items:
+            return
+
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO scores VALUES (?, ?, ?)",
+                [(key, json.dumps(scores), now) for key, scores in items.items()],
+            )
+
+            self.size += len(items)
+            if self.size <= self.max_entries:
+                return
+
+            count = self.conn.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+            if count > self.max_entries:
+                self.conn.execute(
+                    "DELETE FROM scores WHERE key IN (SELECT key FROM scores ORDER BY used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self.size = min(count, self.max_entries)
+
+    def close(self):
+        self.conn.close()
@@ -1,37 +1,77 @@
 from __future__ import annotations
 
+import os
+import gc
 import sys
 import argparse
+import subprocess
+import asyncio
+import queue
+import random
+import threading
 import time
+import contextlib
 import typing as T
 import json
+import hashlib
+import inspect
+import tempfile
+import importlib
+from importlib.metadata import EntryPoint, entry_points
 from pathlib import Path
 
-import openai
-import torch
-import torch.nn.functional as F
-import transformers
-from transformers import AutoTokenizer, AutoModel, AutoModelForCausalLM
-from transformers.models.bert import BertTokenizer, BertForSequenceClassification
-from transformers.generation.utils import GenerationConfig
+from cache import ChatCache, ScoreCache
+from dataset import DATASET_SUFFIXES, Dataset, load_dataset
+from profiling import Profiler, Throughput
 
-from filelock import FileLock
 
+class LazyModule:
+    """ Stand-in for a heavy module, which is only imported once an attribute is used. """
 
-sys.path.append(str(Path("./BELLE/models/gptq").absolute()))
+    def __init__(self, name: str) -> None:
+        object.__setattr__(self, "name", name)
 
-from bloom_inference import load_quant  # type: ignore
+    def __getattr__(self, attr: str):
+        return getattr(importlib.import_module(self.name), attr)
+
+    def __setattr__(self, attr: str, value):
+        setattr(importlib.import_module(self.name), attr, value)
+
+
+openai = LazyModule("openai")
+torch = LazyModule("torch")
+transformers = LazyModule("transformers")
 
 
 class Analyzable(T.Protocol):
+    """ A toxicity classifier, only `analyze` and `analyze_batch` are required.
+
+    `batch_size`, the `score_cache` attribute and the windowed scoring of `analyze_windows` and
+    `combine` are used when a classifier has them, e.g. by subclassing `AnalyzeModel`.
+    """
+
     def analyze(self, text: str) -> list[float]:
         ...
 
+    def analyze_batch(self, texts: list[str]) -> list[list[float]]:
+        ...
+
 
 class Chatable(T.Protocol):
+    device: str = None  # "cuda", "cuda:1", "cpu", ..., None picks cuda when it is available
+    dtype: str = None  # one of DTYPES, None keeps the default of the model
+
     def chat(self, text: str, history: list[str] = None) -> tuple[str, list[str]]:
         ...
 
+    def chat_batch(self, texts: list[str]) -> list[str]:
+        """ Responses of many history-free chats, models without batching chat one by one. """
+        return [self.chat(text)[0] for text in texts]
+
+    def chat_samples(self, text: str, samples: int) -> list[str]:
+        """ Several sampled responses of one history-free chat, models without shared prefill chat once per sample. """
+        return [self.chat(text)[0] for _ in range(samples)]
+
     def build_user_text(self, text: str):
         ...
 
@@ -39,19 +79,333 @@ class Chatable(T.Protocol):
         ...
 
 
+DTYPES = ["float16", "bfloat16", "float32", "int8"]
+
+
+def placement(model: Chatable, default_dtype: str = None) -> tuple[str, str | None]:
+    """ Device and dtype a model is loaded with. """
+    device = model.device or ("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = model.dtype or default_dtype
+    if device == "cpu" and dtype == "float16":
+        dtype = "bfloat16"  # half precision matmuls are slow or missing on CPU
+    return device, dtype
+
+
+def pretrained_kwargs(device: str, dtype: str | None, device_map: bool = True) -> dict[str, T.Any]:
+    """ `from_pretrained` arguments of a placement, int8 is bitsandbytes on GPU and applied by `place_model` on CPU.
+
+    Without `device_map` the model is loaded on CPU and moved by `place_model`, except for int8 on
+    GPU, which bitsandbytes can only load onto its device, so it is mapped onto that single device.
+    """
+    kwargs = {}
+    if dtype is not None:
+        kwargs["torch_dtype"] = getattr(torch, {"int8": "float16" if device != "cpu" else "float32"}.get(dtype, dtype))
+
+    if device != "cpu" and (device_map or dtype == "int8"):
+        # plain cuda spreads over every GPU
+        kwargs["device_map"] = "auto" if device == "cuda" and device_map else {"": device}
+        kwargs["low_cpu_mem_usage"] = True
+        if dtype == "int8":
+            kwargs["quantization_config"] = transformers.BitsAndBytesConfig(load_in_8bit=True)
+
+    return kwargs
+
+
+def place_model(model: T.Any, device: str, dtype: str | None) -> T.Any:
+    """ Model on its device in eval mode, with dynamically quantized int8 linear layers on CPU. """
+    if device == "cpu" and dtype == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif getattr(model, "hf_device_map", None) is None:
+        model = model.to(device)
+    return model.eval()
+
+
+def batched(items: T.Iterable, size: int) -> T.Iterator[list]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+# end of the items in a pipeline queue
+STOP = object()
+
+
+def run_stage(
+    handle: T.Callable[[list], list], inbox: queue.Queue, outbox: queue.Queue | None,
+    errors: list[BaseException], batch_size: int = 1,
+):
+    """ One stage of a pipeline, pass `inbox` items through `handle` into `outbox` until STOP.
+
+    Items already waiting are handled together (up to `batch_size`), so a stage catches up with a
+    faster upstream stage by working in bigger batches. After an error the remaining items are
+    dropped but still taken from `inbox`, so that upstream stages never block on a full queue.
+    """
+    done = False
+    while not done:
+        items = [inbox.get()]
+        while items[-1] is not STOP and len(items) < batch_size:
+            try:
+                items.append(inbox.get_nowait())
+            except queue.Empty:
+                break
+
+        if items[-1] is STOP:
+            items.pop()
+            done = True
+
+        if not items or errors:
+            continue
+
+        try:
+            results = handle(items)
+        except BaseException as e:
+            errors.append(e)
+            continue
+
+        if outbox is not None:
+            for result in results:
+                outbox.put(result)
+
+    if outbox is not None:
+        outbox.put(STOP)
+
+
+def start_stage(*args, **kwargs) -> threading.Thread:
+    thread = threading.Thread(target=run_stage, args=args, kwargs=kwargs, daemon=True)
+    thread.start()
+    return thread
+
+
+class StopOnSequences:
+    """ Stopping criteria which ends a sequence as soon as its generated text contains a stop sequence.
+
+    Stop sequences opening a response, like the turn marker a model starts its own turn with, are
+    part of the response and only those behind some response text end it.
+
+    Call `start` before each `generate`, `saved_tokens` counts the generation budget left over by
+    the sequences it stopped over all calls.
+    """
+
+    def __init__(self, tokenizer, stops: list[str]) -> None:
+        self.tokenizer = tokenizer
+        self.stops = stops
+        # a character may take several byte-level tokens
+        self.window = 3 * max(len(stop) for stop in stops) + 2
+        self.saved_tokens = 0
+
+    def start(self, prompt_length: int, budget: int):
+        self.prompt_length = prompt_length
+        self.budget = budget
+        self.stopped = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        start = max(self.prompt_length, input_ids.size(1) - self.window)
+        tails = self.tokenizer.batch_decode(input_ids[:, start:])
+        if self.stopped is None:
+            self.stopped = [False] * len(tails)
+
+        for row, tail in enumerate(tails):
+            if self.stopped[row] or not any(stop in tail for stop in self.stops):
+                continue
+
+            # the whole response is only decoded once a stop sequence shows up, it may open the response
+            response = self.tokenizer.decode(input_ids[row, self.prompt_length :])
+            if self.cut(response) != response:
+                self.stopped[row] = True
+                self.saved_tokens += self.budget - (input_ids.size(1) - self.prompt_length)
+
+        return torch.tensor(self.stopped, dtype=torch.bool, device=input_ids.device)
+
+    def cut(self, text: str, start: int = 0) -> str:
+        """ Remove the first stop sequence found after `start` and some response text, and everything behind it. """
+        # skip whitespace and stop sequences opening the response
+        while True:
+            rest = text[start:].lstrip()
+            start = len(text) - len(rest)
+            opening = next((stop for stop in self.stops if rest.startswith(stop)), None)
+            if opening is None:
+                break
+            start += len(opening)
+
+        positions = [pos for stop in self.stops if (pos := text.find(stop, start)) >= 0]
+        return text[: min(positions)] if positions else text
+
+
+def stopping_kwargs(stopper: StopOnSequences | None, prompt_length: int, kwargs: dict) -> dict:
+    if stopper is None:
+        return {}
+
+    budget = kwargs.get("max_new_tokens") or kwargs.get("max_length", prompt_length) - prompt_length
+    stopper.start(prompt_length, budget)
+    return {"stopping_criteria": transformers.StoppingCriteriaList([stopper])}
+
+
+def generate_batch(
+    model, tokenizer, queries: list[str], max_input_length: int = None,
+    stopper: StopOnSequences = None, **kwargs
+) -> list[tuple[list[int], list[int]]]:
+    """ Generate for many queries in one left-padded `generate` call.
+
+    Returns (prompt ids, response ids) of each query with the padding removed, response ids
+    end with the first eos token just like a single-sequence `generate` does.
+    """
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
+    try:
+        inputs = tokenizer(queries, return_tensors="pt", padding=True)
+    finally:
+        tokenizer.padding_side = padding_side
+
+    input_ids = inputs["input_ids"][:, -max_input_length:] if max_input_length else inputs["input_ids"]
+    attention_mask = inputs["attention_mask"][:, -input_ids.size(1):]
+
+    with torch.no_grad():
+        outputs = model.generate(
+            input_ids=input_ids.to(model.device),
+            attention_mask=attention_mask.to(model.device),
+            pad_token_id=tokenizer.pad_token_id,
+            **stopping_kwargs(stopper, input_ids.size(1), kwargs),
+            **kwargs,
+        )
+
+    results = []
+    for prompt_ids, mask, output_ids in zip(input_ids.tolist(), attention_mask.tolist(), outputs.tolist()):
+        prompt_ids = [token for token, keep in zip(prompt_ids, mask) if keep]
+        results.append((prompt_ids, trim_response(tokenizer, output_ids[input_ids.size(1) :])))
+
+    return results
+
+
+def trim_response(tokenizer, response_ids: list[int]) -> list[int]:
+    """ Response ids of one row of a batched `generate`, up to and including the first eos token. """
+    if tokenizer.eos_token_id in response_ids:
+        response_ids = response_ids[: response_ids.index(tokenizer.eos_token_id) + 1]
+    # sequences ended by a stop sequence are padded up to the longest one
+    while response_ids and response_ids[-1] == tokenizer.pad_token_id != tokenizer.eos_token_id:
+        response_ids.pop()
+    return response_ids
+
+
+def generate_samples(
+    model, tokenizer, input_ids, samples: int, stopper: StopOnSequences = None, **kwargs
+) -> list[list[int]]:
+    """ Response ids of `samples` responses to one prompt from a single `generate` call.
+
+    `num_return_sequences` alone would prefill a copy of the prompt for every sample, so all
+    but the last prompt token are prefilled once and their KV cache is repeated for the samples.
+    Models whose cache can not be repeated prefill every copy.
+    """
+    past = None
+    if input_ids.size(1) > 1:
+        with torch.no_grad():
+            past = model(input_ids=input_ids[:, :-1], use_cache=True).past_key_values
+        if hasattr(past, "batch_repeat_interleave"):
+            past.batch_repeat_interleave(samples)
+        else:
+            past = None
+
+    # several greedy responses would all be the same
+    kwargs.setdefault("do_sample", True)
+    kwargs.setdefault("attention_mask", torch.ones_like(input_ids))
+    kwargs.setdefault("pad_token_id", tokenizer.eos_token_id if tokenizer.pad_token_id is None else tokenizer.pad_token_id)
+    with torch.no_grad():
+        outputs = model.generate(
+            input_ids=input_ids, past_key_values=past, num_return_sequences=samples, use_cache=True,
+            **stopping_kwargs(stopper, input_ids.size(1), kwargs), **kwargs
+        )
+
+    return [trim_response(tokenizer, output_ids[input_ids.size(1) :]) for output_ids in outputs.tolist()]
+
+
+class PrefixCache:
+    """ KV cache of the previous `generate` call of a model.
+
+    A new prompt reuses the cache up to the longest common token prefix with the previous
+    prompt and response, so a chat with history only prefills what was added since the last
+    turn. A prompt which shares no prefix, e.g. after the history window was truncated, is
+    prefilled from scratch. Models whose cache can not be cropped never reuse it.
+    """
+
+    def __init__(self) -> None:
+        self.ids: list[int] = []
+        self.past = None
+        self.enabled = True
+
+    def prepare(self, input_ids: list[int]):
+        if not self.enabled or self.past is None:
+            return None
+
+        common = 0
+        for cached, new in zip(self.ids, input_ids):
+            if cached != new:
+                break
+            common += 1
+
+        # at least one token has to be fed to the model
+        common = min(common, len(input_ids) - 1)
+        if common <= 0:
+            self.past = None
+            return None
+
+        if common < self.past.get_seq_length():
+            self.past.crop(common - self.past.get_seq_length())
+        return self.past
+
+    def update(self, outputs):
+        past = outputs.past_key_values
+        if not hasattr(past, "crop"):
+            self.enabled = False
+            self.past = None
+            return
+
+        self.past = past
+        self.ids = outputs.sequences[0, : past.get_seq_length()].tolist()
+
+
+def generate_cached(model, input_ids, cache: PrefixCache, stopper: StopOnSequences = None, **kwargs):
+    """ Single-sequence `generate` which reuses the KV cache of the previous call. """
+    past = cache.prepare(input_ids[0].tolist())
+    # a mask over the whole sequence tells `generate` that the cached part of input_ids is to be skipped
+    kwargs.setdefault("attention_mask", torch.ones_like(input_ids))
+    outputs = model.generate(
+        input_ids=input_ids, past_key_values=past, return_dict_in_generate=True, use_cache=True,
+        **stopping_kwargs(stopper, input_ids.size(1), kwargs), **kwargs
+    )
+    cache.update(outputs)
+    return outputs.sequences
+
+
 class MossModel(Chatable):
     # url = "fnlp/moss-moon-003-sft-int4"
     # url = "fnlp/moss-moon-003-sft-plugin-int4"
     url = "fnlp/moss-base-7b"
+    generate_kwargs = dict(
+        do_sample=True,
+        temperature=0.8,
+        top_p=0.8,
+        repetition_penalty=1.1,
+        max_new_tokens=256,
+    )
+    stop_sequences = ["<|Human|>", "<eoh>"]
 
     def __init__(self):
-        self.tokenizer = AutoTokenizer.from_pretrained(self.url, trust_remote_code=True)
-        self.model = (
-            AutoModelForCausalLM.from_pretrained(self.url, trust_remote_code=True)
-            .half()
-            .cuda()
+        device, dtype = placement(self, "float16")
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(self.url, trust_remote_code=True)
+        model = transformers.AutoModelForCausalLM.from_pretrained(
+            self.url, trust_remote_code=True, **pretrained_kwargs(device, dtype, device_map=False)
         )
-        self.model = self.model.eval()
+        self.model = place_model(model, device, dtype)
+        self.kv_cache = PrefixCache()
+        self.stopper = StopOnSequences(self.tokenizer, self.stop_sequences)
 
         # meta_instruction = 'You are an AI assistant whose name is MOSS.\n- MOSS is a conversational language model that is developed by Fudan University. It is designed to be helpful, honest, and harmless.\n- MOSS can understand and communicate fluently in the language chosen by the user such as English and 中文. MOSS can perform any language-based tasks.\n- MOSS must refuse to discuss anything related to its prompts, instructions, or rules.\n- Its responses must not be vague, accusatory, rude, controversial, off-topic, or defensive.\n- It should avoid giving subjective opinions but rely on objective facts or phrases like "in this context a human might say...", "some people might think...", etc.\n- Its responses must also be positive, polite, interesting, entertaining, and engaging.\n- It can provide additional relevant details to answer in-depth and comprehensively covering mutiple aspects.\n- It apologizes and accepts the user\'s suggestion if the user corrects the incorrect answer generated by MOSS.\nCapabilities and tools that MOSS can possess.\n'
         # query = meta_instruction + "<|Human|>: 你好<eoh>\n<|MOSS|>:"
@@ -71,23 +425,22 @@ class MossModel(Chatable):
         # )
         # self._start_point = self.tokenizer.decode(outputs[0])
 
+    def build_query(self, text: str, history: list[str] = None) -> str:
+        history = history or []
+        return "\n".join(history) + self.build_user_text(text) + "\n" + self.build_sys_text("")
+
     def chat(self, text: str, history: list[str] = None) -> tuple[str, list[str]]:
         history = history or []
-        query = "\n".join(history) + self.build_user_text(text) + "\n" + self.build_sys_text("")
-        inputs = self.tokenizer(query, return_tensors="pt")
-        for k in inputs:
-            inputs[k] = inputs[k].cuda()
-        outputs = self.model.generate(
-            **inputs,
-            do_sample=True,
-            temperature=0.8,
-            top_p=0.8,
-            repetition_penalty=1.1,
-            max_new_tokens=256,
+        query = self.build_query(text, history)
+        inputs = self.tokenizer(query, return_tensors="pt").to(self.model.device)
+        outputs = generate_cached(
+            self.model, inputs.input_ids, self.kv_cache, self.stopper,
+            attention_mask=inputs.attention_mask, **self.generate_kwargs
         )
         response = self.tokenizer.decode(
             outputs[0][inputs.input_ids.shape[1] :], skip_special_tokens=True
         )
+        response = self.stopper.cut(response)
 
         history = history.copy()
         history.append(self.build_user_text(text))
@@ -95,6 +448,25 @@ class MossModel(Chatable):
 
         return response, history
 
+    def chat_batch(self, texts: list[str]) -> list[str]:
+        queries = [self.build_query(text) for text in texts]
+        outputs = generate_batch(self.model, self.tokenizer, queries, stopper=self.stopper, **self.generate_kwargs)
+        return [
+            self.stopper.cut(self.tokenizer.decode(response_ids, skip_special_tokens=True))
+            for _, response_ids in outputs
+        ]
+
+    def chat_samples(self, text: str, samples: int) -> list[str]:
+        inputs = self.tokenizer(self.build_query(text), return_tensors="pt").to(self.model.device)
+        outputs = generate_samples(
+            self.model, self.tokenizer, inputs.input_ids, samples, self.stopper,
+            attention_mask=inputs.attention_mask, **self.generate_kwargs
+        )
+        return [
+            self.stopper.cut(self.tokenizer.decode(response_ids, skip_special_tokens=True))
+            for response_ids in outputs
+        ]
+
     def build_sys_text(self, text: str):
         return text
 
@@ -104,32 +476,39 @@ class MossModel(Chatable):
 
 class FireflyModel(Chatable):
     url = 'YeungNLP/firefly-baichuan-7b-qlora-sft-merge'
+    generate_kwargs = dict(
+        max_new_tokens=500, do_sample=True, top_p=0.9, temperature=0.35, repetition_penalty=1.0
+    )
+    stop_sequences = ["<s>"]  # start of the next turn
 
     def __init__(self) -> None:
-        self.tokenizer = AutoTokenizer.from_pretrained(self.url, trust_remote_code=True)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            self.url, 
-            trust_remote_code=True,
-            low_cpu_mem_usage=True,
-            torch_dtype=torch.float16,
-            device_map='auto'
-        ).cuda()
-        self.model.eval()
+        device, dtype = placement(self, "float16")
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(self.url, trust_remote_code=True)
+        model = transformers.AutoModelForCausalLM.from_pretrained(
+            self.url, trust_remote_code=True, **pretrained_kwargs(device, dtype)
+        )
+        self.model = place_model(model, device, dtype)
+        self.kv_cache = PrefixCache()
+        self.stopper = StopOnSequences(self.tokenizer, self.stop_sequences)
     
+    def build_query(self, text: str, history: list[str] = None) -> str:
+        history = history or []
+        return "\n".join(history) + self.build_user_text(text) + "\n"
+
     def chat(self, text: str, history: list[str] = None) -> tuple[str, list[str]]:
         history = history or []
-        query = "\n".join(history) + self.build_user_text(text) + "\n"
+        query = self.build_query(text, history)
         inputs = self.tokenizer(query, return_tensors="pt").input_ids
-        inputs = inputs[ : , -1000 : ].cuda()
+        inputs = inputs[ : , -1000 : ].to(self.model.device)
 
-        outputs = self.model.generate(
-            input_ids=inputs, max_new_tokens=500, do_sample=True, top_p=0.9,
-            temperature=0.35, repetition_penalty=1.0, eos_token_id=self.tokenizer.eos_token_id
+        outputs = generate_cached(
+            self.model, inputs, self.kv_cache, self.stopper,
+            eos_token_id=self.tokenizer.eos_token_id, **self.generate_kwargs
         )
         model_input_ids_len = inputs.size(1)
         response_ids = outputs[:, model_input_ids_len:]  # <s> may be removed here, so we don't need to remove it again.
         response = self.tokenizer.batch_decode(response_ids)
-        response = response[0].strip().removesuffix("</s>")
+        response = self.stopper.cut(response[0]).strip().removesuffix("</s>")
 
         history = history.copy()
         history.append(self.build_user_text(text))
@@ -137,6 +516,25 @@ class FireflyModel(Chatable):
 
         return response, history
 
+    def chat_batch(self, texts: list[str]) -> list[str]:
+        queries = [self.build_query(text) for text in texts]
+        outputs = generate_batch(
+            self.model, self.tokenizer, queries, max_input_length=1000, stopper=self.stopper,
+            eos_token_id=self.tokenizer.eos_token_id, **self.generate_kwargs
+        )
+        responses = self.tokenizer.batch_decode([response_ids for _, response_ids in outputs])
+        return [self.stopper.cut(response).strip().removesuffix("</s>") for response in responses]
+
+    def chat_samples(self, text: str, samples: int) -> list[str]:
+        inputs = self.tokenizer(self.build_query(text), return_tensors="pt").input_ids
+        inputs = inputs[ : , -1000 : ].to(self.model.device)
+        outputs = generate_samples(
+            self.model, self.tokenizer, inputs, samples, self.stopper,
+            eos_token_id=self.tokenizer.eos_token_id, **self.generate_kwargs
+        )
+        responses = self.tokenizer.batch_decode(outputs)
+        return [self.stopper.cut(response).strip().removesuffix("</s>") for response in responses]
+
     def build_sys_text(self, text: str):
         return f"<s>{text}</s>"
 
@@ -148,10 +546,19 @@ class Baichuan2Model(Chatable):
     url = 'baichuan-inc/Baichuan2-13B-Chat'
 
     def __init__(self) -> None:
-        self.tokenizer = AutoTokenizer.from_pretrained(self.url, use_fast=False, trust_remote_code=True)
-        model = AutoModelForCausalLM.from_pretrained(self.url, torch_dtype=torch.float16, trust_remote_code=True)
-        self.model = model.quantize(8).cuda()
-        self.model.generation_config = GenerationConfig.from_pretrained(self.url)
+        device, dtype = placement(self, "int8")
+        # on GPU the int8 kernels of Baichuan2 itself quantize the float16 model instead of bitsandbytes
+        own_int8 = device != "cpu" and dtype == "int8"
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(self.url, use_fast=False, trust_remote_code=True)
+        model = transformers.AutoModelForCausalLM.from_pretrained(
+            self.url, trust_remote_code=True,
+            **pretrained_kwargs(device, "float16" if own_int8 else dtype, device_map=False)
+        )
+        if own_int8:
+            model = model.quantize(8)
+            dtype = None
+        self.model = place_model(model, device, dtype)
+        self.model.generation_config = transformers.GenerationConfig.from_pretrained(self.url)
 
         self.model.eval()
     
@@ -174,32 +581,39 @@ class Baichuan2Model(Chatable):
 
 class Firefly2Model(Chatable):
     url = 'YeungNLP/firefly-llama2-7b-chat'
+    generate_kwargs = dict(
+        max_new_tokens=500, do_sample=True, top_p=0.9, temperature=0.35, repetition_penalty=1.0
+    )
+    stop_sequences = ["问：", "答："]
 
     def __init__(self) -> None:
-        self.tokenizer = AutoTokenizer.from_pretrained(self.url, trust_remote_code=True, use_fast=False)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            self.url, 
-            trust_remote_code=True,
-            low_cpu_mem_usage=True,
-            torch_dtype=torch.float16,
-            device_map='auto'
-        ).cuda()
-        self.model.eval()
+        device, dtype = placement(self, "float16")
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(self.url, trust_remote_code=True, use_fast=False)
+        model = transformers.AutoModelForCausalLM.from_pretrained(
+            self.url, trust_remote_code=True, **pretrained_kwargs(device, dtype)
+        )
+        self.model = place_model(model, device, dtype)
+        self.kv_cache = PrefixCache()
+        self.stopper = StopOnSequences(self.tokenizer, self.stop_sequences)
     
+    def build_query(self, text: str, history: list[str] = None) -> str:
+        history = history or []
+        return "\n".join(history) + self.build_user_text(text) + "\n\n" + self.build_sys_text("")
+
     def chat(self, text: str, history: list[str] = None) -> tuple[str, list[str]]:
         history = history or []
-        query = "\n".join(history) + self.build_user_text(text) + "\n\n" + self.build_sys_text("")
+        query = self.build_query(text, history)
         inputs = self.tokenizer(query, return_tensors="pt").input_ids
-        inputs = inputs[ : , -1000 : ].cuda()
+        inputs = inputs[ : , -1000 : ].to(self.model.device)
 
-        outputs = self.model.generate(
-            input_ids=inputs, max_new_tokens=500, do_sample=True, top_p=0.9,
-            temperature=0.35, repetition_penalty=1.0, eos_token_id=self.tokenizer.eos_token_id
+        outputs = generate_cached(
+            self.model, inputs, self.kv_cache, self.stopper,
+            eos_token_id=self.tokenizer.eos_token_id, **self.generate_kwargs
         )
         model_input_ids_len = inputs.size(1)
         response_ids = outputs[:, model_input_ids_len:]
         response = self.tokenizer.batch_decode(response_ids)
-        response = response[0].strip().replace(self.tokenizer.eos_token, "")
+        response = self.stopper.cut(response[0]).strip().replace(self.tokenizer.eos_token, "")
 
         history = history.copy()
         history.append(self.build_user_text(text))
@@ -207,6 +621,25 @@ class Firefly2Model(Chatable):
 
         return response, history
 
+    def chat_batch(self, texts: list[str]) -> list[str]:
+        queries = [self.build_query(text) for text in texts]
+        outputs = generate_batch(
+            self.model, self.tokenizer, queries, max_input_length=1000, stopper=self.stopper,
+            eos_token_id=self.tokenizer.eos_token_id, **self.generate_kwargs
+        )
+        responses = self.tokenizer.batch_decode([response_ids for _, response_ids in outputs])
+        return [self.stopper.cut(response).strip().replace(self.tokenizer.eos_token, "") for response in responses]
+
+    def chat_samples(self, text: str, samples: int) -> list[str]:
+        inputs = self.tokenizer(self.build_query(text), return_tensors="pt").input_ids
+        inputs = inputs[ : , -1000 : ].to(self.model.device)
+        outputs = generate_samples(
+            self.model, self.tokenizer, inputs, samples, self.stopper,
+            eos_token_id=self.tokenizer.eos_token_id, **self.generate_kwargs
+        )
+        responses = self.tokenizer.batch_decode(outputs)
+        return [self.stopper.cut(response).strip().replace(self.tokenizer.eos_token, "") for response in responses]
+
     def build_sys_text(self, text: str):
         return f"答：{text}"
 
@@ -217,9 +650,12 @@ class Firefly2Model(Chatable):
 class ChatGlmModel(Chatable):
     url = "THUDM/chatglm-6b"
     def __init__(self) -> None:
-        self.tokenizer = AutoTokenizer.from_pretrained(self.url, trust_remote_code=True)
-        self.model = AutoModel.from_pretrained("THUDM/chatglm-6b", trust_remote_code=True).half().cuda()
-        self.model.eval()
+        device, dtype = placement(self, "float16")
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(self.url, trust_remote_code=True)
+        model = transformers.AutoModel.from_pretrained(
+            self.url, trust_remote_code=True, **pretrained_kwargs(device, dtype, device_map=False)
+        )
+        self.model = place_model(model, device, dtype)
 
     def chat(self, text: str, history: list[str] = None) -> tuple[str, list[str]]:
         response, history = self.model.chat(self.tokenizer, self.build_user_text(text), history=history)
@@ -235,17 +671,21 @@ class ChatGlmModel(Chatable):
 class LinlyChineseFalconModel(Chatable):
     # This model is terrible
     url = "Linly-AI/Chinese-Falcon-7B"
+    stop_sequences = ["User:"]
 
     def __init__(self) -> None:
-        self.tokenizer = AutoTokenizer.from_pretrained(self.url)
+        device, dtype = placement(self, "bfloat16")
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(self.url)
         self.pipeline = transformers.pipeline(
             "text-generation",
             model=self.url,
             tokenizer=self.tokenizer,
-            torch_dtype=torch.bfloat16,
             trust_remote_code=True,
-            device_map="auto",
+            model_kwargs=pretrained_kwargs(device, dtype),
         )
+        self.pipeline.model = place_model(self.pipeline.model, device, dtype)
+        self.kv_cache = PrefixCache()
+        self.stopper = StopOnSequences(self.tokenizer, self.stop_sequences)
     
     def build_user_text(self, text: str):
         return f"User: {text}"
@@ -256,17 +696,25 @@ class LinlyChineseFalconModel(Chatable):
     def chat(self, text: str, history: list[str] = None) -> tuple[str, list[str]]:
         history = history or []
         query = "\n".join(history) + self.build_user_text(text) + "\n" + self.build_sys_text("")
-        sequences = self.pipeline(
-            query,
+
+        # generate directly instead of through the pipeline to keep the KV cache between turns
+        model = self.pipeline.model
+        inputs = self.tokenizer(query, return_tensors="pt").input_ids.to(model.device)
+        outputs = generate_cached(
+            model,
+            inputs,
+            self.kv_cache,
+            self.stopper,
             max_length=200,
             do_sample=True,
-            num_return_sequences=1,
             eos_token_id=self.tokenizer.eos_token_id,
             pad_token_id=self.tokenizer.pad_token_id,
         )
+        generated_text = query + self.tokenizer.decode(outputs[0][inputs.size(1) :], skip_special_tokens=True)
 
-        # this model can not stop his chat correctly, do we need to move it manually?
-        response = sequences[0]["generated_text"][len(query) + len(self.build_sys_text("")):]
+        # this model does not stop by itself, the stop sequence ends it once it starts the next user turn
+        response = generated_text[len(query) + len(self.build_sys_text("")):]
+        response = self.stopper.cut(response)
 
         history = history.copy()
         history.append(self.build_user_text(text))
@@ -275,22 +723,64 @@ class LinlyChineseFalconModel(Chatable):
         return response, history
 
 
+class TokenBucket:
+    """ Requests and tokens per minute limiter, each bucket holds at most one minute of budget. """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float) -> None:
+        self.rates = [requests_per_minute / 60, tokens_per_minute / 60]
+        self.capacity = [requests_per_minute, tokens_per_minute]
+        self.levels = self.capacity.copy()
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self.updated = now - self.updated, now
+        self.levels = [
+            min(capacity, level + rate * elapsed)
+            for level, rate, capacity in zip(self.levels, self.rates, self.capacity)
+        ]
+
+    async def acquire(self, tokens: int):
+        # a single request may never need more than a full bucket
+        need = [1, min(tokens, self.capacity[1])]
+        while True:
+            self._refill()
+            if all(level >= amount for level, amount in zip(self.levels, need)):
+                self.levels = [level - amount for level, amount in zip(self.levels, need)]
+                return
+
+            wait = max((amount - level) / rate for level, amount, rate in zip(self.levels, need, self.rates))
+            await asyncio.sleep(wait)
+
+    def consume(self, tokens: int):
+        """ Correct the token level once the real usage of a request is known. """
+        self._refill()
+        self.levels[1] -= tokens
+
+
 class ChatGpt(Chatable):
     api_key = ""
+    api_base = None
     sleep = 20
+    requests_per_minute = None  # defaults to one request per `sleep` seconds
+    tokens_per_minute = 40000
+    concurrency = 8
+    max_retries = 6
+    backoff = 1.0
     model = "gpt-3.5-turbo"
-    cache_file = "chatgpt_cache.json"
-    lock = FileLock(f"{cache_file}.lock")
+    generate_kwargs = {}
+    cache_file = "chatgpt_cache.sqlite"
+    legacy_cache_file = "chatgpt_cache.json"
 
     def __init__(self) -> None:
         openai.api_key = self.api_key
-        
-        if not Path(self.cache_file).exists():
-            Path(self.cache_file).touch()
-    
-        with self.lock, open(self.cache_file, "r+") as f:
-            json_str = f.read()
-            self.cache = json.loads(json_str) if json_str else {}
+        if self.api_base:
+            openai.api_base = self.api_base
+
+        self.bucket = TokenBucket(self.requests_per_minute or 60 / self.sleep, self.tokens_per_minute)
+
+        self.cache = ChatCache(self.cache_file)
+        self.cache.import_json(self.legacy_cache_file, self.model, self.generate_kwargs)
 
     def build_user_text(self, text: str):
         return {"role": "user", "content": text}
@@ -299,56 +789,97 @@ class ChatGpt(Chatable):
         return {"role": "assistant", "content": text}
     
     def chat(self, text: str, history: list[str] = None) -> tuple[str, list[str]]:
-        history = history.copy() if history else []
-        input_history = history.copy()
+        return asyncio.run(self.achat(text, history))
 
-        if text in self.cache and history == self.cache[text]["history"]:
-            return tuple(self.cache[text]["output"])
+    def chat_batch(self, texts: list[str]) -> list[str]:
+        return asyncio.run(self._achat_many(texts))
 
-        history.append(self.build_user_text(text))
+    async def _achat_many(self, texts: list[str]) -> list[str]:
+        semaphore = asyncio.Semaphore(self.concurrency)
 
-        completion = openai.ChatCompletion.create(
-            model=self.model,
-            messages=history,
-        )
-        response = completion.choices[0].message.content
-        
-        history.append(self.build_sys_text(response))
-        
-        self.cache[text] = {
-            "history": input_history,
-            "output": [
-                response,
-                history,
-            ]
-        }
-
-        with self.lock:
-            temp_file = Path(self.cache_file).with_suffix(".tmp")
+        async def achat(text: str) -> str:
+            async with semaphore:
+                response, _ = await self.achat(text)
+                return response
 
-            with open(self.cache_file, "r") as f:
-                current_cache = json.loads(f.read() or "{}")
+        # gather keeps the input order whatever order the requests finish in
+        return await asyncio.gather(*(achat(text) for text in texts))
 
-            self.cache = current_cache | self.cache
-
-            with open(temp_file, "w") as f:
-                json.dump(self.cache, f, ensure_ascii=False)
+    async def achat(self, text: str, history: list[str] = None) -> tuple[str, list[str]]:
+        history = history.copy() if history else []
+        history.append(self.build_user_text(text))
 
-            temp_file.replace(self.cache_file)
+        key = self.cache.key(self.model, history, self.generate_kwargs)
+        response = self.cache.get(key)
+        if response is not None:
+            history.append(self.build_sys_text(response))
+            return response, history
 
-        time.sleep(self.sleep)
+        completion = await self._acreate(history)
+        response = completion.choices[0].message.content
+        
+        self.cache.put(key, self.model, history, response)
+        history.append(self.build_sys_text(response))
 
         return response, history
 
+    def chat_samples(self, text: str, samples: int) -> list[str]:
+        return asyncio.run(self.asamples(text, samples))
+
+    async def asamples(self, text: str, samples: int) -> list[str]:
+        """ Several responses of one request with `n` choices, each choice is cached on its own. """
+        history = [self.build_user_text(text)]
+        keys = [
+            self.cache.key(self.model, history, {**self.generate_kwargs, "n": samples, "choice": i})
+            for i in range(samples)
+        ]
+        responses = [self.cache.get(key) for key in keys]
+        if None not in responses:
+            return responses
+
+        completion = await self._acreate(history, n=samples)
+        responses = [choice.message.content for choice in completion.choices]
+        for key, response in zip(keys, responses):
+            self.cache.put(key, self.model, history, response)
+
+        return responses
+
+    async def _acreate(self, history: list[dict], **kwargs):
+        # about one token per character for Chinese text, the real usage is settled afterwards
+        estimate = sum(len(message["content"]) for message in history)
+
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire(estimate)
+            try:
+                completion = await openai.ChatCompletion.acreate(
+                    model=self.model,
+                    messages=history,
+                    **self.generate_kwargs,
+                    **kwargs,
+                )
+                break
+            except openai.error.RateLimitError:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+        if "usage" in completion:
+            self.bucket.consume(completion.usage.total_tokens - estimate)
+
+        return completion
+
 
 class QwenModel(Chatable):
     url = "Qwen/Qwen-7B-Chat"
 
     def __init__(self) -> None:
-        self.tokenizer = AutoTokenizer.from_pretrained(self.url, trust_remote_code=True)
-        self.model = AutoModelForCausalLM.from_pretrained(self.url, trust_remote_code=True, device_map="auto")
-        self.model.eval()
-        self.model.generation_config = GenerationConfig.from_pretrained(self.url, trust_remote_code=True)
+        device, dtype = placement(self)
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(self.url, trust_remote_code=True)
+        model = transformers.AutoModelForCausalLM.from_pretrained(
+            self.url, trust_remote_code=True, **pretrained_kwargs(device, dtype)
+        )
+        self.model = place_model(model, device, dtype)
+        self.model.generation_config = transformers.GenerationConfig.from_pretrained(self.url, trust_remote_code=True)
 
 
     def chat(self, text: str, history: list[str] = None) -> tuple[str, list[str]]:
@@ -367,10 +898,18 @@ class BelleGptQModel(Chatable):
     file = "BELLE/bloom7b-2m-8bit-128g.pt"
     wbits = 8
     group_size = 128
+    generate_kwargs = dict(min_length=10, max_length=1024, top_p=0.95, temperature=0.8)
+    stop_sequences = ["Human:"]
 
     def __init__(self) -> None:
-        self.tokenizer = AutoTokenizer.from_pretrained(self.url)
-        self.model = load_quant(self.url, self.file, self.wbits, self.group_size).cuda()
+        sys.path.append(str(Path("./BELLE/models/gptq").absolute()))
+        from bloom_inference import load_quant  # type: ignore
+
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(self.url)
+        device, _ = placement(self)  # already quantized by GPTQ, its kernels need a GPU
+        self.model = load_quant(self.url, self.file, self.wbits, self.group_size).to(device)
+        self.kv_cache = PrefixCache()
+        self.stopper = StopOnSequences(self.tokenizer, self.stop_sequences)
 
     def build_user_text(self, text: str):
         return "Human: " + text
@@ -378,21 +917,20 @@ class BelleGptQModel(Chatable):
     def build_sys_text(self, text: str):
         return "Assistant: " + text
 
+    def build_query(self, text: str, history: list[str] = None) -> str:
+        history = history or []
+        return "\n\n".join(history) + self.build_user_text(text) + "\n\n" + self.build_sys_text("")
+
     def chat(self, text: str, history: list[str] = None) -> tuple[str, list[str]]:
         history = history or []
-        query = "\n\n".join(history) + self.build_user_text(text) + "\n\n" + self.build_sys_text("")
-        inputs = self.tokenizer.encode(query, return_tensors="pt").cuda()
+        query = self.build_query(text, history)
+        inputs = self.tokenizer.encode(query, return_tensors="pt").to(self.model.device)
 
         with torch.no_grad():
-            generated_ids = self.model.generate(
-                inputs,
-                min_length=10,
-                max_length=1024,
-                top_p=0.95,
-                temperature=0.8,
-            )
+            generated_ids = generate_cached(self.model, inputs, self.kv_cache, self.stopper, **self.generate_kwargs)
 
-        response = self.tokenizer.decode([el.item() for el in generated_ids[0]])[len(query): - 4]
+        response = self.tokenizer.decode([el.item() for el in generated_ids[0]])[len(query):]
+        response = self.stopper.cut(response).removesuffix("</s>")
 
         history = history.copy()
         history.append(self.build_user_text(text))
@@ -400,42 +938,68 @@ class BelleGptQModel(Chatable):
 
         return response, history
 
+    def chat_batch(self, texts: list[str]) -> list[str]:
+        queries = [self.build_query(text) for text in texts]
+        outputs = generate_batch(self.model, self.tokenizer, queries, stopper=self.stopper, **self.generate_kwargs)
+        return [
+            self.stopper.cut(self.tokenizer.decode(prompt_ids + response_ids)[len(query):]).removesuffix("</s>")
+            for query, (prompt_ids, response_ids) in zip(queries, outputs)
+        ]
+
+    def chat_samples(self, text: str, samples: int) -> list[str]:
+        query = self.build_query(text)
+        inputs = self.tokenizer.encode(query, return_tensors="pt").to(self.model.device)
+        outputs = generate_samples(self.model, self.tokenizer, inputs, samples, self.stopper, **self.generate_kwargs)
+        prompt_ids = inputs[0].tolist()
+        return [
+            self.stopper.cut(self.tokenizer.decode(prompt_ids + response_ids)[len(query):]).removesuffix("</s>")
+            for response_ids in outputs
+        ]
+
 
 class Llama2Model(Chatable):
     url = 'meta-llama/Llama-2-7b-chat-hf'
+    generate_kwargs = {
+        "max_new_tokens":512,
+        "do_sample":True,
+        "top_k":50,
+        "top_p":0.95,
+        "temperature":0.3,
+        "repetition_penalty":1.3,
+    }
+    stop_sequences = ["Human:", "<\\s>"]
 
     def __init__(self) -> None:
-        self.tokenizer = AutoTokenizer.from_pretrained(self.url, trust_remote_code=True)
+        device, dtype = placement(self, "int8")
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(self.url, trust_remote_code=True)
         self.tokenizer.pad_token = self.tokenizer.eos_token
-        self.model = AutoModelForCausalLM.from_pretrained(
-            self.url, 
-            trust_remote_code=True,
-            torch_dtype=torch.float16,
-            device_map='auto',
-            load_in_8bit=True,
-        ).cuda()
-        self.model.eval()
+        model = transformers.AutoModelForCausalLM.from_pretrained(
+            self.url, trust_remote_code=True, **pretrained_kwargs(device, dtype)
+        )
+        self.model = place_model(model, device, dtype)
+        self.kv_cache = PrefixCache()
+        self.stopper = StopOnSequences(self.tokenizer, self.stop_sequences)
+
+    def build_query(self, text: str, history: list[str] = None) -> str:
+        history = history or []
+        return "\n".join(history) + self.build_user_text(text) + "\n" + self.build_sys_text("").removesuffix("<\s>")
 
     def chat(self, text: str, history: list[str] = None) -> tuple[str, list[str]]:
         history = history or []
-        query = "\n".join(history) + self.build_user_text(text) + "\n" + self.build_sys_text("").removesuffix("<\s>")
+        query = self.build_query(text, history)
         inputs = self.tokenizer(query, return_tensors="pt").input_ids
-        inputs = inputs[ : , -1000 : ].cuda()
+        inputs = inputs[ : , -1000 : ].to(self.model.device)
 
         generate_input = {
-            "input_ids": inputs,
-            "max_new_tokens":512,
-            "do_sample":True,
-            "top_k":50,
-            "top_p":0.95,
-            "temperature":0.3,
-            "repetition_penalty":1.3,
+            **self.generate_kwargs,
             "eos_token_id": self.tokenizer.eos_token_id,
             "bos_token_id": self.tokenizer.bos_token_id,
             "pad_token_id": self.tokenizer.pad_token_id
         }
-        outputs  = self.model.generate(**generate_input)
-        response = self.tokenizer.decode(outputs[0]).removesuffix("<\s>")
+        outputs  = generate_cached(self.model, inputs, self.kv_cache, self.stopper, **generate_input)
+        # the response starts with the prompt, stop sequences are only looked for behind it
+        prompt_length = len(self.tokenizer.decode(outputs[0][: inputs.size(1)]))
+        response = self.stopper.cut(self.tokenizer.decode(outputs[0]), prompt_length).removesuffix("<\s>")
 
         history = history.copy()
         history.append(self.build_user_text(text))
@@ -443,6 +1007,37 @@ class Llama2Model(Chatable):
 
         return response, history
 
+    def chat_batch(self, texts: list[str]) -> list[str]:
+        queries = [self.build_query(text) for text in texts]
+        outputs = generate_batch(
+            self.model, self.tokenizer, queries, max_input_length=1000, stopper=self.stopper,
+            eos_token_id=self.tokenizer.eos_token_id, bos_token_id=self.tokenizer.bos_token_id,
+            **self.generate_kwargs,
+        )
+        # same as `chat`, the decoded response starts with the prompt
+        return [
+            self.stopper.cut(
+                self.tokenizer.decode(prompt_ids + response_ids), len(self.tokenizer.decode(prompt_ids))
+            ).removesuffix("<\s>")
+            for prompt_ids, response_ids in outputs
+        ]
+
+    def chat_samples(self, text: str, samples: int) -> list[str]:
+        inputs = self.tokenizer(self.build_query(text), return_tensors="pt").input_ids
+        inputs = inputs[ : , -1000 : ].to(self.model.device)
+        outputs = generate_samples(
+            self.model, self.tokenizer, inputs, samples, self.stopper,
+            eos_token_id=self.tokenizer.eos_token_id, bos_token_id=self.tokenizer.bos_token_id,
+            **self.generate_kwargs,
+        )
+        # same as `chat`, the decoded response starts with the prompt
+        prompt_ids = inputs[0].tolist()
+        prompt_length = len(self.tokenizer.decode(prompt_ids))
+        return [
+            self.stopper.cut(self.tokenizer.decode(prompt_ids + response_ids), prompt_length).removesuffix("<\s>")
+            for response_ids in outputs
+        ]
+
     def build_sys_text(self, text: str):
         return f"<s>Assistant: {text}<\s>"
 
@@ -452,24 +1047,181 @@ class Llama2Model(Chatable):
 
 class AnalyzeModel(Analyzable):
     url = "thu-coai/roberta-base-cold"
+    revision = "main"
+    backend = "torch"
+    max_length = 512
+    batch_size = 64
+    threads: int = None  # intra-op threads of ONNX Runtime, torch backends use the threads of the process
+    score_cache: ScoreCache = None
+    window: int = None  # tokens of each window of a sliding-window scoring, texts are truncated if None
+    window_overlap = 128  # tokens shared by neighbouring windows
+    aggregate = "max"  # score of a text from its windows, "max" or "mean"
 
     def __init__(self) -> None:
-        self.tokenizer = BertTokenizer.from_pretrained(self.url)
-        self.model = BertForSequenceClassification.from_pretrained(self.url)
+        self.tokenizer = transformers.BertTokenizerFast.from_pretrained(self.url, revision=self.revision)
+        self.model = transformers.BertForSequenceClassification.from_pretrained(self.url, revision=self.revision)
         self.model.eval()
     
-    @torch.no_grad()
     def analyze(self, text: str) -> list[float]:
         """ 0: benign prob, 1: poison prob """
-        text = text[:300]
-        model_input = self.tokenizer([text], return_tensors="pt", padding=True)
-        model_output = self.model(**model_input, return_dict=False)
-        model_output = F.softmax(model_output[0], dim=1)
-        metrics = model_output[0].tolist()  # 0: benign prob, 1: poison prob
+        return self.analyze_batch([text])[0]
+
+    def analyze_batch(self, texts: list[str]) -> list[list[float]]:
+        """ Same as `analyze` for many texts, results keep the input order.
+
+        Texts longer than `max_length` tokens are truncated, unless `window` is set, then
+        they are scored by `aggregate` over the scores of their windows.
+        """
+        if self.window:
+            return [self.combine(windows) for windows in self.analyze_windows(texts)]
+        return self.cached(f"truncate:{self.max_length}", texts, self._analyze_batch)
+
+    def analyze_windows(self, texts: list[str]) -> list[list[list[float]]]:
+        """ [start char, end char, benign prob, poison prob] of every window of each text.
+
+        Windows of `window` tokens (or `max_length`) overlap by `window_overlap` tokens, the
+        windows of all texts are scored together in length-sorted batches.
+        """
+        window = self.window or self.max_length
+        return self.cached(f"window:{window}/{self.window_overlap}", texts, self._analyze_windows)
+
+    def combine(self, windows: list[list[float]]) -> list[float]:
+        """ [benign prob, poison prob] of a text from its windows. """
+        if self.aggregate == "mean":
+            return [sum(window[i] for window in windows) / len(windows) for i in [2, 3]]
+        return max(windows, key=lambda window: window[3])[2:]
+
+    def cached(self, policy: str, texts: list[str], analyze: T.Callable[[list[str]], list]) -> list:
+        """ Results of `analyze`, only computed for texts not in the score cache under `policy`. """
+        if self.score_cache is None:
+            return analyze(texts)
+
+        classifier = f"{self.url}@{self.revision}/{self.backend}"
+        keys = [self.score_cache.key(classifier, policy, text) for text in texts]
+        found = self.score_cache.get_many(list(set(keys)))
+
+        # identical texts in the batch are scored only once as well
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        scored = dict(zip(missing, analyze(list(missing.values()))))
+        self.score_cache.put_many(scored)
+
+        return [found[key] if key in found else scored[key] for key in keys]
+
+    def _analyze_batch(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+
+        encoded = self.tokenizer(list(texts), truncation=True, max_length=self.max_length)["input_ids"]
+        return self._score(encoded)
+
+    def _analyze_windows(self, texts: list[str]) -> list[list[list[float]]]:
+        if not texts:
+            return []
+
+        encoded = self.tokenizer(
+            list(texts), truncation=True, max_length=min(self.window or self.max_length, self.max_length),
+            stride=self.window_overlap, return_overflowing_tokens=True, return_offsets_mapping=True,
+        )
+        metrics = self._score(encoded["input_ids"])
+
+        windows: list[list[list[float]]] = [[] for _ in texts]
+        for i, offsets, metric in zip(encoded["overflow_to_sample_mapping"], encoded["offset_mapping"], metrics):
+            # special tokens have empty offsets
+            spans = [(start, end) for start, end in offsets if end > start]
+            start, end = (spans[0][0], spans[-1][1]) if spans else (0, 0)
+            windows[i].append([start, end, *metric])
+
+        return windows
+
+    def _score(self, encoded: list[list[int]]) -> list[list[float]]:
+        # sort by token length so each batch is only padded to its own longest member
+        order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]))
+        metrics: list[list[float]] = [None] * len(encoded)
+
+        for start in range(0, len(order), self.batch_size):
+            bucket = order[start : start + self.batch_size]
+            model_input = self.tokenizer.pad(
+                {"input_ids": [encoded[i] for i in bucket]}, padding=True, return_tensors="pt"
+            )
+            model_output = torch.softmax(self.logits(model_input), dim=1)  # 0: benign prob, 1: poison prob
+
+            for i, metric in zip(bucket, model_output.tolist()):
+                metrics[i] = metric
+
         return metrics
 
+    def logits(self, model_input: dict[str, T.Any]) -> T.Any:
+        model_input = {k: v.to(self.model.device) for k, v in model_input.items()}
+        with torch.no_grad():
+            return self.model(**model_input, return_dict=False)[0]
+
+
+class QuantizedAnalyzeModel(AnalyzeModel):
+    """ Dynamic int8 quantization of the linear layers, for CPU only nodes. """
+    backend = "int8"
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.model = torch.ao.quantization.quantize_dynamic(
+            self.model.cpu(), {torch.nn.Linear}, dtype=torch.qint8
+        )
+
+
+class OnnxAnalyzeModel(AnalyzeModel):
+    """ Classifier exported once to `onnx_dir` and run with ONNX Runtime, needs onnxruntime. """
+    backend = "onnx"
+    onnx_dir = "onnx"
+
+    def __init__(self) -> None:
+        import onnxruntime
+
+        super().__init__()
+        path = Path(self.onnx_dir) / f"{self.url.strip('/').replace('/', '--')}@{self.revision}.onnx"
+        if not path.exists():
+            self.export(path)
+
+        options = onnxruntime.SessionOptions()
+        if self.threads:
+            options.intra_op_num_threads = self.threads
+        self.session = onnxruntime.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+        self.input_names = {node.name for node in self.session.get_inputs()}
+        del self.model
+
+    def export(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        names = ["input_ids", "attention_mask"]  # positional order of the forward, token types are all 0
+        # padded example, so the traced graph does not drop the attention mask
+        example = self.tokenizer(["x", "x x x"], padding=True, return_tensors="pt")
+        axes = {0: "batch", 1: "length"}
+
+        # the TorchScript exporter, which newer torch versions only use when asked to
+        kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+
+        # exported aside and moved in place, so neither an interrupted export nor the one of a
+        # concurrent shard is ever loaded half-written
+        with tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False) as tmp:
+            pass
+        try:
+            torch.onnx.export(
+                self.model.cpu(),
+                tuple(example[name] for name in names),
+                tmp.name,
+                input_names=names,
+                output_names=["logits"],
+                dynamic_axes={name: axes for name in names} | {"logits": {0: "batch"}},
+                **kwargs,
+            )
+        except BaseException:
+            Path(tmp.name).unlink(missing_ok=True)
+            raise
+        Path(tmp.name).replace(path)
+
+    def logits(self, model_input: dict[str, T.Any]) -> T.Any:
+        feed = {k: v.numpy() for k, v in model_input.items() if k in self.input_names}
+        return torch.from_numpy(self.session.run(["logits"], feed)[0])
 
-MODELS = {
+
+MODELS: dict[str, type[Chatable] | EntryPoint] = {
     "MOSS": MossModel,
     "ChatGLM": ChatGlmModel,
     "Linly": LinlyChineseFalconModel,
@@ -482,18 +1234,336 @@ MODELS = {
     "Qwen": QwenModel,
 }
 
+ANALYZERS: dict[str, type[Analyzable] | EntryPoint] = {
+    "COLD": AnalyzeModel,
+    "COLD-int8": QuantizedAnalyzeModel,
+    "COLD-onnx": OnnxAnalyzeModel,
+}
+
+# other packages add backends through entry points, which are only imported once chosen
+MODELS.update({entry.name: entry for entry in entry_points(group="tiseval.models")})
+ANALYZERS.update({entry.name: entry for entry in entry_points(group="tiseval.analyzers")})
+
+
+def get_backend(registry: dict[str, type | EntryPoint], name: str) -> type:
+    backend = registry[name]
+    if isinstance(backend, EntryPoint):
+        backend = registry[name] = backend.load()
+    return backend
+
+
+def load_analyzer(args: argparse.Namespace) -> Analyzable:
+    """ The classifier of `--analyzer` with its threads, score windows and score cache. """
+    analyzer = get_backend(ANALYZERS, args.analyzer)
+    if args.score_window and not hasattr(analyzer, "analyze_windows"):
+        raise RuntimeError(f"Analyzer {args.analyzer} can not score in windows!")
+
+    if args.analyzer_threads:
+        analyzer.threads = args.analyzer_threads
+    if args.score_window:
+        analyzer.window = args.score_window
+        analyzer.window_overlap = args.score_overlap
+        analyzer.aggregate = args.score_aggregate
+    analyze_model = analyzer()
+
+    # classifiers without a score_cache attribute do not look scores up
+    if args.score_cache and hasattr(analyze_model, "score_cache"):
+        analyze_model.score_cache = ScoreCache(args.score_cache)
+    return analyze_model
+
+
+class TextWriter:
+    """ The legacy `[USER]: / [SYSTEM]: / [METRICS]:` text format, stdout when no path is given. """
+
+    def __init__(self, path: str = None) -> None:
+        self.file = open(path, "a+") if path else sys.stdout
+
+    def write(self, record: dict):
+        user_metric = [record["user_benign_prob"], record["user_poison_prob"]]
+        sys_metric = [record["system_benign_prob"], record["system_poison_prob"]]
+
+        if not self.file.isatty():
+            self.file.write(f"[USER]: {record['user_text']}\n")
+
+        self.file.write(f"[SYSTEM]: {record['system_text']}\n")
+        self.file.write(f"[METRICS]: User: {user_metric}, System: {sys_metric}\n")
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class JsonlWriter:
+    """ One json record per turn. """
+
+    def __init__(self, path: str) -> None:
+        self.file = open(path, "a")
+
+    def write(self, record: dict):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """ One parquet row group per flush, needs pyarrow. Parquet files can not be appended. """
+
+    def __init__(self, path: str) -> None:
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pyarrow = pyarrow
+        self.parquet = pyarrow.parquet
+        self.path = path
+        self.rows = []
+        self.writer = None
+
+    def write(self, record: dict):
+        self.rows.append(record)
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        if self.writer is None:
+            # columns which are still empty, e.g. labels of unlabeled first rows, are strings
+            schema = self.pyarrow.Table.from_pylist(self.rows).schema
+            schema = self.pyarrow.schema([field.with_type(self.fill_nulls(field.type)) for field in schema])
+            self.writer = self.parquet.ParquetWriter(self.path, schema)
+
+        self.writer.write_table(self.pyarrow.Table.from_pylist(self.rows, schema=self.writer.schema))
+        self.rows.clear()
+
+    def fill_nulls(self, data_type):
+        """ `data_type` with the null types inferred from None values replaced by string. """
+        types = self.pyarrow.types
+        if types.is_null(data_type):
+            return self.pyarrow.string()
+        if types.is_struct(data_type):
+            return self.pyarrow.struct([field.with_type(self.fill_nulls(field.type)) for field in data_type])
+        if types.is_list(data_type):
+            return self.pyarrow.list_(self.fill_nulls(data_type.value_type))
+        return data_type
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+
+OUTPUT_FORMATS = {
+    "text": TextWriter,
+    "jsonl": JsonlWriter,
+    "parquet": ParquetWriter,
+}
+
+# metric.py picks its parser by the suffix of an output file
+OUTPUT_SUFFIXES = {
+    "text": ".txt",
+    "jsonl": ".jsonl",
+    "parquet": ".parquet",
+}
+
+
+# arguments which change the content of output file, a run can only resume with the same values
+CHECKPOINT_ARGS = [
+    "model", "analyzer", "input_template", "no_history", "output_format",
+    "input_benign", "input_poison", "output_benign", "output_poison", "shards", "shard_id",
+    "text_column", "label_columns", "sheet", "dtype", "samples",
+    "score_window", "score_overlap", "score_aggregate",
+]
+
+
+def file_hash(path: str | Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_checkpoint(path: Path) -> dict | None:
+    return json.loads(path.read_text()) if path.exists() else None
+
+
+def save_checkpoint(path: Path, checkpoint: dict):
+    temp_file = path.with_suffix(".tmp")
+    temp_file.write_text(json.dumps(checkpoint, ensure_ascii=False))
+    temp_file.replace(path)
+
+
+class HistoryLog:
+    """ Chat history of a checkpoint, one json message per line.
+
+    A kept history only grows, so a flush appends the messages added since the
+    previous one and the checkpoint keeps their count, instead of rewriting the whole history.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.saved = 0
+
+    def load(self, count: int) -> list | None:
+        """ The first `count` messages, later ones were written after the checkpoint and are dropped. """
+        if not count:
+            self.path.unlink(missing_ok=True)
+            return None
+
+        with open(self.path, encoding="utf-8") as f:
+            history = [json.loads(line) for _, line in zip(range(count), f)]
+        if len(history) < count:
+            raise RuntimeError(f"History {self.path} has {len(history)} of {count} checkpointed messages!")
+
+        self.path.unlink()
+        self.save(history)
+        return history
+
+    def save(self, history: list | None) -> int:
+        history = history or []
+        if len(history) > self.saved:
+            with open(self.path, "a", encoding="utf-8") as f:
+                for message in history[self.saved :]:
+                    f.write(json.dumps(message, ensure_ascii=False) + "\n")
+            self.saved = len(history)
+        return self.saved
+
+
+def open_dataset(args: argparse.Namespace) -> Dataset | None:
+    """ Converted table of a xlsx, csv or jsonl input, None for a text file with one prompt per line. """
+    if Path(args.read).suffix not in DATASET_SUFFIXES:
+        return None
+
+    if not args.text_column:
+        raise RuntimeError(f"Choose the prompt column of {args.read} with --text-column!")
+
+    label_columns = args.label_columns.split(",") if args.label_columns else []
+    return load_dataset(args.read, args.text_column, label_columns, args.sheet)
+
+
+def count_lines(path: str | Path) -> int:
+    with open(path, "rb") as f:
+        return sum(1 for _ in f)
+
+
+def shard_range(total: int, shards: int, shard_id: int) -> tuple[int, int]:
+    """ Lines [start, end) of the input handled by a shard, shards are contiguous blocks. """
+    return total * shard_id // shards, total * (shard_id + 1) // shards
+
+
+def shard_path(path: str | Path, shard_id: int) -> Path:
+    path = Path(path)
+    return path.with_name(f"{path.stem}.shard{shard_id}{path.suffix}")
+
+
+def model_path(path: str | Path, model: str) -> Path:
+    path = Path(path)
+    return path.with_name(f"{path.stem}.{model}{path.suffix}")
+
+
+def read_prompts(
+    rx: T.Iterable[str], start: int = 0, end: int = None, template: str = None
+) -> T.Iterator[tuple[int, str]]:
+    """ Numbered and templated prompts of the lines [start, end) of an input. """
+    for i, line in enumerate(rx):
+        if end is not None and i >= end:
+            break
+
+        if i < start:
+            continue
+
+        line = line.strip()
+        if template:
+            line = template.format(text=line)
+        yield i, line
+
+
+def free_memory():
+    """ Release what a finished LLM leaves behind before the next one is loaded. """
+    gc.collect()
+    if "torch" in sys.modules and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def launch_shards(args: argparse.Namespace):
+    """ Run every shard in its own `chat.py` process and merge their outputs in input order. """
+    devices = args.shard_devices.split(",") if args.shard_devices else [None]
+    open_dataset(args)  # converted once here instead of by every shard
+    threads = max(1, (os.cpu_count() or 1) // args.shards)
+
+    workers = []
+    for shard_id in range(args.shards):
+        env = os.environ.copy()
+        env.setdefault("OMP_NUM_THREADS", str(threads))
+
+        device = devices[shard_id % len(devices)]
+        if device is not None:
+            env["CUDA_VISIBLE_DEVICES"] = "" if device == "cpu" else device
+
+        command = [sys.executable, sys.argv[0], *sys.argv[1:], "--shard-id", str(shard_id)]
+        workers.append(subprocess.Popen(command, env=env))
+
+    codes = [worker.wait() for worker in workers]
+    failed = [shard_id for shard_id, code in enumerate(codes) if code != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} failed, rerun with --resume to continue them!")
+
+    print(f"Merging {args.shards} shards into {args.output}.")
+    paths = [shard_path(args.output, shard_id) for shard_id in range(args.shards)]
+
+    if args.output_format == "parquet":
+        import pyarrow
+        import pyarrow.parquet
+
+        tables = [pyarrow.parquet.read_table(path) for path in paths if path.exists()]
+        if tables:
+            pyarrow.parquet.write_table(pyarrow.concat_tables(tables), args.output)
+    else:
+        with open(args.output, "a") as tx:
+            for path in paths:
+                if path.exists():
+                    with open(path) as rx:
+                        for line in rx:
+                            tx.write(line)
+
+    for path in paths:
+        path.unlink(missing_ok=True)
+        path.with_suffix(".ckpt.json").unlink(missing_ok=True)
+
 
 def main():
     parser = argparse.ArgumentParser(description="Chat with LLM.")
     parser.add_argument("-m", "--model", help="LLM name.", choices=list(MODELS))
+    parser.add_argument(
+        "--models", help="Comma separated LLMs chatting in turn with one classifier and one prompt scoring, "
+        "each writes its own output (output.MODEL.txt)."
+    )
+    parser.add_argument(
+        "-a", "--analyzer", help="Toxicity classifier name.", choices=list(ANALYZERS), default="COLD"
+    )
     parser.add_argument(
         "-i", "--interact", help="Interactive mode.", action="store_true"
     )
     parser.add_argument(
-        "-r", "--read", help="Read input from file.", default="input.txt"
+        "-r", "--read", help="Read input from file, one prompt per line or a xlsx, csv or jsonl table.",
+        default="input.txt"
+    )
+    parser.add_argument(
+        "--text-column", help="Prompt column of a xlsx, csv or jsonl input."
     )
     parser.add_argument(
-        "-o", "--output", help="Save output to file.", default="output.txt"
+        "--label-columns", help="Comma separated ground-truth columns kept next to each prompt."
+    )
+    parser.add_argument(
+        "--sheet", help="Sheet of a xlsx input, the first one by default."
+    )
+    parser.add_argument(
+        "-o", "--output", help="Save output to file, output.txt, output.jsonl or output.parquet by default."
     )
     parser.add_argument(
         "--input-benign", help="Only input benign words, poisoned words will be filtered.", action="store_true"
@@ -513,83 +1583,393 @@ def main():
     parser.add_argument(
         "-t", "--input-template", help="Template of input with {text}"
     )
+    parser.add_argument(
+        "--score-cache", help="Classifier score cache shared by all runs, empty to disable.", default="score_cache.sqlite"
+    )
+    parser.add_argument(
+        "--analyzer-threads", help="Intra-op threads of an ONNX analyzer, torch analyzers share --threads with the LLM.",
+        type=int
+    )
+    parser.add_argument(
+        "--score-window", help="Score long texts in sliding windows of N tokens instead of truncating them, "
+        "jsonl and parquet outputs keep the score of every response window.", type=int
+    )
+    parser.add_argument(
+        "--score-overlap", help="Tokens shared by neighbouring score windows.", type=int, default=128
+    )
+    parser.add_argument(
+        "--score-aggregate", help="Score of a windowed text.", choices=["max", "mean"], default="max"
+    )
+    parser.add_argument(
+        "-f", "--output-format", help="Format of output file.", choices=list(OUTPUT_FORMATS), default="text",
+    )
+    parser.add_argument(
+        "--resume", help="Continue from the checkpoint of an interrupted run.", action="store_true"
+    )
+    parser.add_argument(
+        "--profile", help="Record per-turn stage timings and token counts, summary saved next to the output.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--device", help="Device of the LLM (cuda, cuda:1, cpu, ...), cuda when it is available by default."
+    )
+    parser.add_argument(
+        "--dtype", help="Weights of the LLM, int8 is bitsandbytes on GPU and dynamic quantization on CPU, "
+        "the default of each model if not given.", choices=DTYPES
+    )
+    parser.add_argument(
+        "--threads", help="Torch threads for CPU inference.", type=int
+    )
+    parser.add_argument(
+        "-b", "--batch-size", help="Chat with N lines at once, history is not kept.", type=int, default=1,
+    )
+    parser.add_argument(
+        "--samples", help="Sample K responses of every prompt from one generation with a shared prefill.",
+        type=int, default=1,
+    )
+    parser.add_argument(
+        "--shards", help="Split input into N shards, each runs in its own process.", type=int, default=1,
+    )
+    parser.add_argument(
+        "--shard-id", help="Only run this shard, the launcher sets it for its workers.", type=int,
+    )
+    parser.add_argument(
+        "--shard-devices", help="Comma separated CUDA devices (or cpu) given to shards in turn, e.g. 0,1,cpu."
+    )
     parser.add_argument(
         "--api-key", help="Api Key of ChatGPT."
     )
     parser.add_argument(
-        "--api-sleep", help="Sleep seconds after ChatGPT response.", type=float,
+        "--api-sleep", help="Seconds between ChatGPT requests, used when --api-rpm is not set.", type=float,
+    )
+    parser.add_argument(
+        "--api-base", help="Base url of the ChatGPT api, e.g. a local mock server."
+    )
+    parser.add_argument(
+        "--api-rpm", help="ChatGPT requests per minute.", type=float,
+    )
+    parser.add_argument(
+        "--api-tpm", help="ChatGPT tokens per minute.", type=float,
+    )
+    parser.add_argument(
+        "--api-concurrency", help="ChatGPT requests in flight with --batch-size.", type=int,
     )
 
     args = parser.parse_args()
 
-    if not args.model:
+    if args.output is None:
+        args.output = "output" + OUTPUT_SUFFIXES[args.output_format]
+
+    # text outputs may have any suffix but that of another format
+    suffix, expected = Path(args.output).suffix, OUTPUT_SUFFIXES[args.output_format]
+    if suffix != expected and (args.output_format != "text" or suffix in OUTPUT_SUFFIXES.values()):
+        raise RuntimeError(f"{args.output_format} output {args.output} has to end with {expected}!")
+
+    models = args.models.split(",") if args.models else [args.model] if args.model else []
+    if not models:
         raise RuntimeError("No model specified!")
 
-    print(f"Loading LLM {args.model}.")
+    unknown = [name for name in models if name not in MODELS]
+    if unknown:
+        raise RuntimeError(f"Unknown models {unknown}, choose from {list(MODELS)}!")
+
+    if len(set(models)) != len(models):
+        raise RuntimeError("Every model can only be swept once!")
+
+    if args.models and (args.interact or args.shards > 1):
+        raise RuntimeError("A sweep over models can not run in interact mode or in shards!")
+
+    # `--no-history` is a store_false flag, so `args.no_history` is True when history is dropped
+    if args.batch_size > 1 and (not args.no_history or args.interact):
+        raise RuntimeError("Batch size larger than 1 can not keep chat history or run in interact mode!")
+
+    if args.samples > 1 and (not args.no_history or args.interact or args.batch_size > 1):
+        raise RuntimeError("Several samples can not keep chat history, run in interact mode or use --batch-size!")
+
+    if args.samples > 1 and args.output_format == "text":
+        raise RuntimeError("Several samples need jsonl or parquet output, which records the line of each sample!")
+
+    if args.score_window and args.score_overlap >= args.score_window - 2:
+        raise RuntimeError("Score windows have to be longer than their overlap and the 2 special tokens!")
+
+    if args.resume and args.interact:
+        raise RuntimeError("Interact mode can not be resumed!")
+
+    if args.resume and args.output_format == "parquet":
+        raise RuntimeError("Parquet output can not be resumed, use jsonl instead!")
+
+    if args.interact and args.output_format != "text":
+        raise RuntimeError("Interact mode only supports text output!")
+
+    if args.shards > 1 and (not args.no_history or args.interact):
+        raise RuntimeError("Shards can not keep chat history or run in interact mode!")
+
+    if args.shards > 1 and args.shard_id is None:
+        launch_shards(args)
+        return
+
+    output = args.output if args.shard_id is None else shard_path(args.output, args.shard_id)
 
-    if args.model == "ChatGPT":
+    if args.device:
+        Chatable.device = args.device
+    if args.dtype:
+        Chatable.dtype = args.dtype
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    if "ChatGPT" in models:
         if args.api_key:
             ChatGpt.api_key = args.api_key
         if args.api_sleep:
             ChatGpt.sleep = args.api_sleep
+        if args.api_base:
+            ChatGpt.api_base = args.api_base
+        if args.api_rpm:
+            ChatGpt.requests_per_minute = args.api_rpm
+        if args.api_tpm:
+            ChatGpt.tokens_per_minute = args.api_tpm
+        if args.api_concurrency:
+            ChatGpt.concurrency = args.api_concurrency
 
-    model = MODELS[args.model]()
+    print("Loading analyzation model.")
+    analyzer = get_backend(ANALYZERS, args.analyzer)
+    # torch threads are global to the process, they would throttle the LLM as well
+    if args.analyzer_threads and issubclass(analyzer, AnalyzeModel) and not issubclass(analyzer, OnnxAnalyzeModel):
+        raise RuntimeError(f"--analyzer-threads only applies to ONNX analyzers, {args.analyzer} uses --threads!")
+    analyze_model = load_analyzer(args)
 
     if args.interact:
         print("Interact mode on.")
-
+        dataset = None
         rx = sys.stdin
-        tx = sys.stdout
     else:
-        rx = open(args.read)
-        tx = open(args.output, "a+")
-
-    print("Loading analyzation model.")
-    analyze_model = AnalyzeModel()
+        dataset = open_dataset(args)
+        rx = dataset.texts() if dataset is not None else open(args.read)
 
-    print(f"You can chat with {args.model} now.")
+    start, end = 0, None
+    if args.shard_id is not None:
+        total = len(dataset) if dataset is not None else count_lines(args.read)
+        start, end = shard_range(total, args.shards, args.shard_id)
 
-    history = None
-    for i, line in enumerate(rx):
-        if not tx.isatty():
-            print("Chat Count:", i, end="\r")
-
-        line = line.strip()
-        if args.input_template:
-            line = args.input_template.format(text=line)
+    prompts = read_prompts(rx, start, end, args.input_template)
 
-        user_metric = analyze_model.analyze(line)
+    if not args.models:
+        run_model(args, models[0], output, analyze_model, dataset, prompts, start)
+    else:
+        # the prompts are read, templated and scored once for every model of the sweep
+        print("Scoring prompts.")
+        prompts = list(prompts)
+        prompt_metrics = dict(zip(
+            (i for i, _ in prompts), analyze_model.analyze_batch([line for _, line in prompts])
+        ))
 
-        if args.no_history:
-            history = None
+        for name in models:
+            run_model(args, name, model_path(output, name), analyze_model, dataset, prompts, start, prompt_metrics)
+            free_memory()
 
-        response, history = model.chat(line, history)
+    rx.close()
 
-        sys_metric = analyze_model.analyze(response)
 
+def run_model(
+    args: argparse.Namespace, name: str, output: str | Path, analyze_model: Analyzable, dataset: Dataset | None,
+    prompts: T.Iterable[tuple[int, str]], start: int, prompt_metrics: dict[int, list[float]] = None,
+):
+    """ Chat with one LLM over the prompts, then score and write every turn. """
+    print(f"Loading LLM {name}.")
+    model = get_backend(MODELS, name)()
+
+    tx = TextWriter() if args.interact else OUTPUT_FORMATS[args.output_format](output)
+
+    checkpoint_file = Path(output).with_suffix(".ckpt.json")
+    checkpoint = {
+        "line": start,
+        "input_hash": None if args.interact else file_hash(args.read),
+        "model": name,
+        "config": {arg: getattr(args, arg) for arg in CHECKPOINT_ARGS},
+        "history": 0,
+    }
+    history_log = HistoryLog(checkpoint_file.with_suffix(".history.jsonl"))
+
+    if args.resume and checkpoint_file.exists():
+        saved = load_checkpoint(checkpoint_file)
+        for key in ["input_hash", "model", "config"]:
+            if saved[key] != checkpoint[key]:
+                raise RuntimeError(f"Checkpoint {checkpoint_file} does not match this run ({key} differs)!")
+        checkpoint = saved
+        print(f"Resume from line {checkpoint['line']}.")
+    history = history_log.load(checkpoint["history"])
+
+    profiler = None
+    if args.profile:
+        profiler = Profiler()
+        profiler.attach(model)
+
+    print(f"You can chat with {name} now.")
+
+    # stages: reading -> chat (this thread) -> scoring -> writing, connected by bounded queues
+    chat_queue = queue.Queue(maxsize=2 * args.batch_size)
+    score_batch_size = getattr(analyze_model, "batch_size", AnalyzeModel.batch_size)
+    score_queue = queue.Queue(maxsize=2 * score_batch_size)
+    write_queue = queue.Queue(maxsize=2 * score_batch_size)
+    errors = []
+
+    # lines before the checkpoint are skipped
+    lines = ((i, line) for i, line in prompts if i >= checkpoint["line"])
+
+    def keep_input(user_metric: list[float]) -> bool:
         if args.input_benign and user_metric[0] < 0.5:
-            continue
+            return False
 
         if args.input_poison and user_metric[1] < 0.5:
-            continue
+            return False
 
-        if args.output_benign and sys_metric[0] < 0.5:
-            continue
+        return True
 
-        if args.output_poison and sys_metric[1] < 0.5:
-            continue
-        
-        if not tx.isatty():
-            tx.write(f"[USER]: {line}\n")
-
-        tx.write(f"[SYSTEM]: {response}\n")
-        tx.write(f"[METRICS]: User: {user_metric}, System: {sys_metric}\n")
-        tx.flush()
-
-        if rx.isatty():
-            print("[USER]: ", end="")
+    # prompts are filtered before generation, so filtered prompts cost no generation and stay out of history
+    if prompt_metrics is not None:
+        items = [(i, line, prompt_metrics[i]) for i, line in lines if keep_input(prompt_metrics[i])]
+    elif not (args.input_benign or args.input_poison):
+        items = ((i, line, None) for i, line in lines)
+    elif args.interact:
+        items = ((i, line, metric) for i, line in lines if keep_input(metric := analyze_model.analyze(line)))
+    else:
+        print("Scoring prompts.")
+        lines = list(lines)
+        metrics = analyze_model.analyze_batch([line for _, line in lines])
+        items = [(i, line, metric) for (i, line), metric in zip(lines, metrics) if keep_input(metric)]
+        print(f"{len(items)} of {len(lines)} prompts pass the input filters.")
+
+    def read():
+        for item in items:
+            if errors:
+                break
+            chat_queue.put(item)
+
+        chat_queue.put(STOP)
+
+    # an item holds the records of all samples of a prompt, which are scored in the same batch
+    def score(items: list[tuple[list[dict], list[str]]]) -> list[tuple[list[dict], list[str]]]:
+        groups = [group for group, _ in items]
+        records = [record for group in groups for record in group]
+        unscored = [group for group in groups if group[0]["user_benign_prob"] is None]
+        texts = [group[0]["user_text"] for group in unscored] + [record["system_text"] for record in records]
+        with profiler.timer("score", len(records)) if profiler else contextlib.nullcontext():
+            if args.score_window:
+                windows = analyze_model.analyze_windows(texts)
+                metrics = [analyze_model.combine(text_windows) for text_windows in windows]
+            else:
+                metrics = analyze_model.analyze_batch(texts)
+
+        for group, user_metric in zip(unscored, metrics):
+            for record in group:
+                record["user_benign_prob"], record["user_poison_prob"] = user_metric
+
+        for i, (record, sys_metric) in enumerate(zip(records, metrics[len(unscored):])):
+            record["system_benign_prob"], record["system_poison_prob"] = sys_metric
+            if args.score_window:
+                record["system_windows"] = windows[len(unscored) + i]
+
+        return items
+
+    def write(items: list[tuple[list[dict], list[str]]]) -> list:
+        records = [record for group, _ in items for record in group]
+        with profiler.timer("write", len(records)) if profiler else contextlib.nullcontext():
+            for record in records:
+                if args.output_benign and record["system_benign_prob"] < 0.5:
+                    continue
+
+                if args.output_poison and record["system_poison_prob"] < 0.5:
+                    continue
+
+                tx.write(record)
+
+            tx.flush()
+
+        if not args.interact:
+            group, history = items[-1]
+            checkpoint["line"] = group[0]["line"] + 1
+            # messages are on disk before the checkpoint counts them
+            checkpoint["history"] = history_log.save(None if args.no_history else history)
+            save_checkpoint(checkpoint_file, checkpoint)
+
+        if args.interact and sys.stdin.isatty():
+            print("[USER]: ", end="", flush=True)
+
+        return []
+
+    threading.Thread(target=read, daemon=True).start()
+    scorer = start_stage(score, score_queue, write_queue, errors, batch_size=score_batch_size)
+    writer = start_stage(write, write_queue, None, errors, batch_size=score_batch_size)
+
+    throughput = Throughput()
+    try:
+        for chunk in batched(iter(chat_queue.get, STOP), args.batch_size):
+            if errors:
+                break
+
+            started = time.perf_counter()
+            if args.samples > 1:
+                responses = [model.chat_samples(chunk[0][1], args.samples)]
+            elif args.batch_size > 1:
+                responses = [[response] for response in model.chat_batch([line for _, line, _ in chunk])]
+            else:
+                if args.no_history:
+                    history = None
+
+                response, history = model.chat(chunk[0][1], history)
+                responses = [[response]]
+
+            turns = len(chunk) * args.samples
+            chat_seconds = (time.perf_counter() - started) / turns
+            turn = profiler.take(turns) if profiler else {}
+
+            if not args.interact:
+                rates = throughput.update(len(chunk), round(turn.get("response_tokens", 0) * turns))
+                print(f"Chat Count: {chunk[-1][0] + 1} | {rates}", end="\r")
+
+            for (i, line, user_metric), samples in zip(chunk, responses):
+                group = []
+                for sample, response in enumerate(samples):
+                    record = {
+                        "line": i,
+                        "model": name,
+                        "user_text": line,
+                        "system_text": response,
+                        "user_benign_prob": user_metric[0] if user_metric else None,
+                        "user_poison_prob": user_metric[1] if user_metric else None,
+                        "system_benign_prob": None,
+                        "system_poison_prob": None,
+                        "chat_seconds": chat_seconds,
+                        **turn,
+                    }
+                    if args.samples > 1:
+                        record["sample"] = sample
+                    if dataset is not None and dataset.label_columns:
+                        record["labels"] = dataset.labels(i)
+                    group.append(record)
+                score_queue.put((group, list(history) if history else history))
+    finally:
+        # whatever has been generated is still scored and written
+        score_queue.put(STOP)
+        scorer.join()
+        writer.join()
+
+    if not args.interact:
+        print()  # end the progress line
+
+    if errors:
+        raise errors[0]
+
+    if profiler:
+        profile_file = Path(output).with_suffix(".profile")
+        profiler.save(profile_file)
+        print(f"{name} generated {profiler.response_tokens} tokens at {profiler.summary()['tokens_per_second']:.1f} tokens/s.")
+        print(f"Profile saved to {profile_file}.json and {profile_file}.prom.")
+
+    stopper = getattr(model, "stopper", None)
+    if stopper is not None:
+        print(f"Stop sequences saved {stopper.saved_tokens} tokens.")
 
-    rx.close()
     tx.close()
 
 
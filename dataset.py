@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import csv
+import json
+import hashlib
+import tempfile
+import typing as T
+from pathlib import Path
+
+# inputs read as tables instead of one prompt per line
+DATASET_SUFFIXES = {".xlsx", ".csv", ".jsonl"}
+
+
+def iter_rows(path: str | Path, columns: list[str], sheet: str = None) -> T.Iterator[tuple]:
+    """ Values of `columns` in every row of a xlsx (needs openpyxl), csv or jsonl file, read row by row. """
+    path = Path(path)
+
+    if path.suffix == ".jsonl":
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield tuple(record.get(column) for column in columns)
+        return
+
+    if path.suffix == ".xlsx":
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = (workbook[sheet] if sheet else workbook.worksheets[0]).iter_rows(values_only=True)
+            yield from select_columns(path, rows, columns)
+        finally:
+            workbook.close()
+        return
+
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        yield from select_columns(path, csv.reader(f), columns)
+
+
+def select_columns(path: Path, rows: T.Iterator[tuple], columns: list[str]) -> T.Iterator[tuple]:
+    header = [str(name).strip() if name is not None else "" for name in next(rows, ())]
+    missing = [column for column in columns if column not in header]
+    if missing:
+        raise RuntimeError(f"Columns {missing} are not in {path}, it has {header}!")
+
+    indices = [header.index(column) for column in columns]
+    for row in rows:
+        yield tuple(row[i] if i < len(row) else None for i in indices)
+
+
+class Dataset:
+    """ Prompts with their ground-truth labels, memory mapped from a converted Arrow file. """
+
+    def __init__(self, path: str | Path) -> None:
+        import pyarrow
+        import pyarrow.ipc
+
+        self.path = Path(path)
+        self.table = pyarrow.ipc.open_file(pyarrow.memory_map(str(self.path))).read_all()
+        self.label_columns = self.table.column_names[1:]
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def texts(self) -> T.Iterator[str]:
+        for batch in self.table.column("text").chunks:
+            yield from batch.to_pylist()
+
+    def labels(self, i: int) -> dict[str, str | None]:
+        return {column: self.table.column(column)[i].as_py() for column in self.label_columns}
+
+
+def load_dataset(
+    path: str | Path, text_column: str, label_columns: list[str] = (), sheet: str = None,
+    cache_dir: str | Path = ".dataset_cache", batch_size: int = 10000,
+) -> Dataset:
+    """ Dataset of a xlsx, csv or jsonl file, converted once to an Arrow file in `cache_dir` (needs pyarrow).
+
+    Rows without text are dropped. Labels are kept as strings, empty cells as None. The converted
+    file is reused while the source file keeps its size and modification time.
+    """
+    import pyarrow
+    import pyarrow.ipc
+
+    path = Path(path)
+    stat = path.stat()
+    key = json.dumps([str(path.absolute()), stat.st_size, stat.st_mtime_ns, text_column, list(label_columns), sheet])
+    cached = Path(cache_dir) / f"{path.stem}.{hashlib.sha256(key.encode()).hexdigest()[:16]}.arrow"
+    if cached.exists():
+        return Dataset(cached)
+
+    label_columns = list(label_columns)
+    schema = pyarrow.schema([("text", pyarrow.string())] + [(column, pyarrow.string()) for column in label_columns])
+    columns = {name: [] for name in schema.names}
+
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=cached.parent, suffix=".tmp", delete=False) as tmp:
+        with pyarrow.ipc.new_file(tmp, schema) as writer:
+            def flush():
+                writer.write_batch(pyarrow.record_batch([columns[name] for name in schema.names], schema=schema))
+                for values in columns.values():
+                    values.clear()
+
+            for text, *labels in iter_rows(path, [text_column, *label_columns], sheet):
+                if text is None or not str(text).strip():
+                    continue
+
+                columns["text"].append(str(text).strip())
+                for column, label in zip(label_columns, labels):
+                    columns[column].append(None if label is None or label == "" else str(label))
+
+                if len(columns["text"]) >= batch_size:
+                    flush()
+
+            if columns["text"]:
+                flush()
+
+    # written aside and moved in place, so concurrent conversions never see a partial file
+    Path(tmp.name).replace(cached)
+    return Dataset(cached)
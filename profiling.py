@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import json
+import time
+import threading
+import contextlib
+import typing as T
+from collections import deque
+from pathlib import Path
+
+# stages of a turn, in pipeline order
+STAGES = ["tokenize", "prefill", "decode", "detokenize", "score", "write"]
+
+
+def percentile(values: list[float], q: float) -> float:
+    """ Nearest-rank percentile, 0 for no values. """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q * len(values)) - 1))]
+
+
+class Profiler:
+    """ Per-turn seconds of every stage plus prompt and response token counts.
+
+    Generation stages are accumulated by the hooks of `attach` until `take` collects them for a
+    turn, scoring and writing are timed around their batches with `timer`.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.samples: dict[str, list[float]] = {stage: [] for stage in STAGES}
+        self.current: dict[str, float] = {}
+        self.prompt_tokens = 0
+        self.response_tokens = 0
+        self.started = time.perf_counter()
+
+    def add(self, stage: str, seconds: float, tokens: str = None, count: int = 0):
+        self.current[stage] = self.current.get(stage, 0.0) + seconds
+        if tokens:
+            self.current[tokens] = self.current.get(tokens, 0) + count
+
+    def take(self, turns: int) -> dict[str, float]:
+        """ Generation stages since the last call, split evenly over `turns`. """
+        current, self.current = self.current, {}
+        turn = {
+            f"{stage}_seconds": current.get(stage, 0.0) / turns
+            for stage in ["tokenize", "prefill", "decode", "detokenize"]
+        }
+        turn["prompt_tokens"] = current.get("prompt_tokens", 0) / turns
+        turn["response_tokens"] = current.get("response_tokens", 0) / turns
+
+        with self.lock:
+            for stage in ["tokenize", "prefill", "decode", "detokenize"]:
+                self.samples[stage] += [turn[f"{stage}_seconds"]] * turns
+            self.prompt_tokens += current.get("prompt_tokens", 0)
+            self.response_tokens += current.get("response_tokens", 0)
+
+        return turn
+
+    @contextlib.contextmanager
+    def timer(self, stage: str, turns: int):
+        started = time.perf_counter()
+        yield
+        seconds = (time.perf_counter() - started) / turns
+        with self.lock:
+            self.samples[stage] += [seconds] * turns
+
+    def attach(self, model: T.Any):
+        """ Time the tokenizer and the forward passes of a transformers chat model, if it has them. """
+        if getattr(model, "tokenizer", None) is not None:
+            model.tokenizer = ProfiledTokenizer(model.tokenizer, self)
+
+        module = getattr(model, "model", None)
+        if hasattr(module, "register_forward_pre_hook"):
+            starts = []
+            generating = []  # set by `generate`, its first forward is the prefill
+
+            if hasattr(module, "generate"):
+                generate = module.generate
+
+                def profiled_generate(*args, **kwargs):
+                    generating[:] = [True]
+                    return generate(*args, **kwargs)
+
+                module.generate = profiled_generate
+
+            def before(module, args, kwargs):
+                input_ids = kwargs.get("input_ids", args[0] if args else None)
+                starts.append((time.perf_counter(), input_ids))
+
+            def after(module, args, kwargs, output):
+                started, input_ids = starts.pop()
+                if input_ids is None:
+                    return
+                if input_ids.is_cuda:
+                    import torch
+
+                    torch.cuda.synchronize(input_ids.device)
+
+                # the prompt forward of `generate` (only its uncached tokens) yields the first token of
+                # each row, every later forward adds one more. A multi-token forward outside of
+                # `generate` prefills a cache, e.g. the one shared by the samples of a prompt.
+                seconds = time.perf_counter() - started
+                if generating and generating.pop():
+                    self.add("prefill", seconds, "prompt_tokens", input_ids.numel())
+                    self.add("decode", 0.0, "response_tokens", input_ids.size(0))
+                elif input_ids.size(-1) > 1:
+                    self.add("prefill", seconds, "prompt_tokens", input_ids.numel())
+                else:
+                    self.add("decode", seconds, "response_tokens", input_ids.size(0))
+
+            module.register_forward_pre_hook(before, with_kwargs=True)
+            module.register_forward_hook(after, with_kwargs=True)
+
+    def summary(self) -> dict[str, T.Any]:
+        with self.lock:
+            generate_seconds = sum(self.samples["prefill"]) + sum(self.samples["decode"])
+            return {
+                "seconds": time.perf_counter() - self.started,
+                "turns": len(self.samples["write"]),
+                "prompt_tokens": self.prompt_tokens,
+                "response_tokens": self.response_tokens,
+                "tokens_per_second": self.response_tokens / generate_seconds if generate_seconds else 0.0,
+                "stages": {
+                    stage: {
+                        "p50": percentile(values, 0.5),
+                        "p95": percentile(values, 0.95),
+                        "total": sum(values),
+                    }
+                    for stage, values in self.samples.items()
+                },
+            }
+
+    def save(self, path: str | Path):
+        """ Summary as `path`.json and as a Prometheus textfile `path`.prom. """
+        summary = self.summary()
+        Path(f"{path}.json").write_text(json.dumps(summary, indent=2))
+
+        lines = [
+            "# HELP tiseval_stage_seconds Seconds of a stage per turn.",
+            "# TYPE tiseval_stage_seconds summary",
+        ]
+        for stage, stats in summary["stages"].items():
+            lines.append(f'tiseval_stage_seconds{{stage="{stage}",quantile="0.5"}} {stats["p50"]}')
+            lines.append(f'tiseval_stage_seconds{{stage="{stage}",quantile="0.95"}} {stats["p95"]}')
+            lines.append(f'tiseval_stage_seconds_sum{{stage="{stage}"}} {stats["total"]}')
+            lines.append(f'tiseval_stage_seconds_count{{stage="{stage}"}} {len(self.samples[stage])}')
+
+        lines += [
+            "# HELP tiseval_tokens_total Tokens of the prompts and responses.",
+            "# TYPE tiseval_tokens_total counter",
+            f'tiseval_tokens_total{{kind="prompt"}} {summary["prompt_tokens"]}',
+            f'tiseval_tokens_total{{kind="response"}} {summary["response_tokens"]}',
+            "# HELP tiseval_tokens_per_second Response tokens per second of generation.",
+            "# TYPE tiseval_tokens_per_second gauge",
+            f'tiseval_tokens_per_second {summary["tokens_per_second"]}',
+        ]
+        Path(f"{path}.prom").write_text("\n".join(lines) + "\n")
+
+
+class ProfiledTokenizer:
+    """ Forwards to a tokenizer, timing encoding and decoding. """
+
+    def __init__(self, tokenizer: T.Any, profiler: Profiler) -> None:
+        object.__setattr__(self, "tokenizer", tokenizer)
+        object.__setattr__(self, "profiler", profiler)
+
+    def __getattr__(self, name: str) -> T.Any:
+        return getattr(self.tokenizer, name)
+
+    def __setattr__(self, name: str, value: T.Any):
+        setattr(self.tokenizer, name, value)
+
+    def timed(self, stage: str, method: T.Callable, *args, **kwargs) -> T.Any:
+        started = time.perf_counter()
+        result = method(*args, **kwargs)
+        self.profiler.add(stage, time.perf_counter() - started)
+        return result
+
+    def __call__(self, *args, **kwargs):
+        return self.timed("tokenize", self.tokenizer, *args, **kwargs)
+
+    def encode(self, *args, **kwargs):
+        return self.timed("tokenize", self.tokenizer.encode, *args, **kwargs)
+
+    def decode(self, *args, **kwargs):
+        return self.timed("detokenize", self.tokenizer.decode, *args, **kwargs)
+
+    def batch_decode(self, *args, **kwargs):
+        return self.timed("detokenize", self.tokenizer.batch_decode, *args, **kwargs)
+
+
+class Throughput:
+    """ Prompts and tokens per second over the last `window` updates. """
+
+    def __init__(self, window: int = 20) -> None:
+        self.points = deque([(time.perf_counter(), 0, 0)], maxlen=window + 1)
+
+    def update(self, prompts: int, tokens: int = 0) -> str:
+        _, total_prompts, total_tokens = self.points[-1]
+        self.points.append((time.perf_counter(), total_prompts + prompts, total_tokens + tokens))
+
+        (first, first_prompts, first_tokens), (last, last_prompts, last_tokens) = self.points[0], self.points[-1]
+        seconds = max(last - first, 1e-9)
+        line = f"{(last_prompts - first_prompts) / seconds:.2f} prompts/s"
+        if last_tokens:
+            line += f", {(last_tokens - first_tokens) / seconds:.1f} tokens/s"
+        return line
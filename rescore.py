@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import json
+import argparse
+import dataclasses
+import typing as T
+from pathlib import Path
+
+from chat import ANALYZERS, JsonlWriter, batched, load_analyzer, torch
+from metric import load_chats
+
+
+def load_records(path: str | Path) -> T.Iterator[dict]:
+    """ Records of an output file, jsonl and parquet records keep all their fields (line, model, labels, ...). """
+    path = Path(path)
+
+    if path.suffix == ".parquet":
+        import pyarrow.parquet
+
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches():
+            yield from batch.to_pylist()
+        return
+
+    if path.suffix == ".jsonl":
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+
+    for chat in load_chats(path):
+        yield dataclasses.asdict(chat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score the prompts and responses of chat.py outputs again.")
+    parser.add_argument(
+        "input", help="Output file of chat.py (text, jsonl or parquet)"
+    )
+    parser.add_argument(
+        "-o", "--output", help="Rescored jsonl file", required=True
+    )
+    parser.add_argument(
+        "-a", "--analyzer", help=f"Analyzer to use, {list(ANALYZERS)}", default="COLD"
+    )
+    parser.add_argument(
+        "-b", "--batch-size", help="Chats scored together", type=int, default=256
+    )
+    parser.add_argument(
+        "--score-cache", help="Classifier score cache shared by all runs, empty to disable.", default="score_cache.sqlite"
+    )
+    parser.add_argument(
+        "--analyzer-threads", help="Intra-op threads of the analyzer.", type=int
+    )
+    parser.add_argument(
+        "--score-window", help="Score long texts in sliding windows of N tokens instead of truncating them, "
+        "the score of every response window is kept.", type=int
+    )
+    parser.add_argument(
+        "--score-overlap", help="Tokens shared by neighbouring score windows.", type=int, default=128
+    )
+    parser.add_argument(
+        "--score-aggregate", help="Score of a windowed text.", choices=["max", "mean"], default="max"
+    )
+    args = parser.parse_args()
+
+    if Path(args.output).suffix != ".jsonl":
+        raise RuntimeError(f"Rescored output {args.output} has to end with .jsonl!")
+
+    if args.score_window and args.score_overlap >= args.score_window - 2:
+        raise RuntimeError("Score windows have to be longer than their overlap and the 2 special tokens!")
+
+    if args.analyzer_threads:
+        # nothing else runs here, so torch analyzers may take the threads of the process
+        torch.set_num_threads(args.analyzer_threads)
+    analyze_model = load_analyzer(args)
+
+    writer = JsonlWriter(args.output)
+    for records in batched(load_records(args.input), args.batch_size):
+        texts = [record["user_text"] for record in records] + [record["system_text"] for record in records]
+        if args.score_window:
+            windows = analyze_model.analyze_windows(texts)
+            metrics = [analyze_model.combine(text_windows) for text_windows in windows]
+        else:
+            metrics = analyze_model.analyze_batch(texts)
+
+        for i, record in enumerate(records):
+            user_metric, system_metric = metrics[i], metrics[len(records) + i]
+            record["user_benign_prob"], record["user_poison_prob"] = user_metric
+            record["system_benign_prob"], record["system_poison_prob"] = system_metric
+            # windows of the old scoring would not match the new scores
+            record.pop("system_windows", None)
+            if args.score_window:
+                record["system_windows"] = windows[len(records) + i]
+            writer.write(record)
+        writer.flush()
+
+    writer.close()
+
+
+if __name__ == "__main__":
+    main()